@@ -0,0 +1,318 @@
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+
+
+class CorpusCache():
+    """Content-addressed on-disk cache for cleaned text and token lists, so
+    NLP preprocessing doesn't need to be rerun when neither the input nor the
+    parameters have changed.
+
+    Each result is stored as one uncompressed `.npz` file of numpy arrays:
+    text as UTF-8 bytes with an offsets index, and tokens as int32 IDs into a
+    vocabulary with an offsets index per document. The file name is a hash
+    of the input data, the function (including the source of its module)
+    and its arguments.
+
+    Supported results are lists or Series of strings (i.e. from
+    `nlp_prep.clean_docs_batch`), lists of token lists (i.e. from
+    `nlp_prep.tokenize_lemma_corpus`) and dicts of token lists keyed on
+    target value (i.e. from `nlp_prep.tokenize_corpus_dict_tweet`).
+
+    *** Arguments
+
+    cache_dir: string, default `.nlp_cache`. Directory to store cached
+    results in. Created if it doesn't exist.
+
+    max_bytes: int, default 2 GB. Once the cache is larger than this, the
+    least recently used results are deleted.
+
+    *** Example
+
+    cache = CorpusCache('data/cache/')
+    df['cleaned'] = cache.cached_call(nlp_prep.clean_docs_batch, df['message'])
+    """
+
+    def __init__(self, cache_dir='.nlp_cache', max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, data, func, *args, **kwargs):
+        """Returns the hex digest identifying a call of `func` on `data` with
+        the given arguments. `data` can be a DataFrame, Series or list.
+
+        The source of the module defining `func` is part of the key, so
+        editing anything in that module invalidates its cached results.
+        Changes to helpers in other modules don't; use `clear` after those.
+        """
+        if not isinstance(data, (pd.DataFrame, pd.Series)):
+            data = pd.Series(list(data), dtype=object)
+
+        h = hashlib.sha256()
+        try:
+            hashed = pd.util.hash_pandas_object(data, index=True)
+        except TypeError:
+            # unhashable cells, i.e. token lists, are hashed by their repr
+            if isinstance(data, pd.DataFrame):
+                hashed = pd.util.hash_pandas_object(
+                    data.astype(object).applymap(repr), index=True)
+            else:
+                hashed = pd.util.hash_pandas_object(
+                    data.astype(object).map(repr), index=True)
+        h.update(hashed.values.tobytes())
+        if isinstance(data, pd.DataFrame):
+            h.update(repr(list(data.columns)).encode())
+
+        h.update(f"{func.__module__}.{func.__qualname__}".encode())
+        # the source of the whole module, so a change to a helper that
+        # `func` calls also changes the key
+        try:
+            h.update(inspect.getsource(inspect.getmodule(func)).encode())
+        except (TypeError, OSError):
+            # no source available, i.e. builtins or functions defined in an
+            # interactive session
+            code = getattr(func, '__code__', None)
+            if code is not None:
+                h.update(code.co_code)
+                h.update(repr(code.co_consts).encode())
+
+        h.update(repr(args).encode())
+        h.update(repr(sorted(kwargs.items())).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        """Loads a cached result, or returns None if `key` isn't cached."""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path, allow_pickle=False) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            result = _decode_result(meta, arrays)
+
+        # mark as recently used for eviction
+        os.utime(path)
+        return result
+
+    def put(self, key, result):
+        """Saves a result to the cache. Returns False, and warns without
+        saving, if the result type (or its index) isn't supported, or if
+        the result alone is larger than `max_bytes`.
+        """
+        arrays = _encode_result(result)
+        if arrays is None:
+            warnings.warn(f"{type(result).__name__} result (or its index) "
+                          "isn't supported by CorpusCache, so it was not "
+                          "cached.")
+            return False
+
+        # write to a temp file first so a crash can't leave a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        if os.path.getsize(tmp_path) > self.max_bytes:
+            os.remove(tmp_path)
+            warnings.warn("Result is larger than the cache's max_bytes, so "
+                          "it was not cached.")
+            return False
+        os.replace(tmp_path, self._path(key))
+
+        self.evict()
+        return True
+
+    def cached_call(self, func, data, *args, **kwargs):
+        """Returns `func(data, *args, **kwargs)`, loading it from the cache
+        if the same call has been made before, and otherwise running it and
+        caching the result.
+        """
+        key = self.key(data, func, *args, **kwargs)
+        result = self.get(key)
+        if result is None:
+            result = func(data, *args, **kwargs)
+            self.put(key, result)
+        return result
+
+    def size(self):
+        """Total size in bytes of the cached results."""
+        return sum(os.path.getsize(path) for path in self._entries())
+
+    def _entries(self):
+        return [os.path.join(self.cache_dir, name)
+                for name in os.listdir(self.cache_dir)
+                if name.endswith('.npz')]
+
+    def evict(self):
+        """Deletes least recently used results until the cache fits in
+        `max_bytes`.
+        """
+        entries = sorted(self._entries(), key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in entries)
+
+        for path in entries:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def clear(self):
+        """Deletes every cached result."""
+        for path in self._entries():
+            os.remove(path)
+
+
+def _encode_strings(strings, prefix):
+    """Encodes a list of strings (or None or NaN for missing values) as one
+    UTF-8 byte array, an offsets array, a missing value mask and a mask of
+    which missing values are None.
+    """
+    missing = np.array([not isinstance(s, str) for s in strings], dtype=bool)
+    is_none = np.array([s is None for s in strings], dtype=bool)
+    encoded = [s.encode('utf-8') if isinstance(s, str) else b''
+               for s in strings]
+
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+
+    return {f"{prefix}_bytes": np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            f"{prefix}_offsets": offsets,
+            f"{prefix}_missing": missing,
+            f"{prefix}_none": is_none}
+
+
+def _decode_strings(arrays, prefix):
+    """Reverses `_encode_strings`. Missing values are None or np.nan, as
+    they were encoded.
+    """
+    raw = arrays[f"{prefix}_bytes"].tobytes()
+    offsets = arrays[f"{prefix}_offsets"]
+    missing = arrays[f"{prefix}_missing"]
+    is_none = arrays[f"{prefix}_none"]
+
+    return [(None if is_none[i] else np.nan) if missing[i]
+            else raw[offsets[i]:offsets[i + 1]].decode('utf-8')
+            for i in range(len(missing))]
+
+
+def _encode_token_lists(token_lists):
+    """Encodes a list of token lists as a vocabulary, int32 token IDs and an
+    offsets array marking where each list starts.
+    """
+    vocab = {}
+    ids = np.fromiter((vocab.setdefault(token, len(vocab))
+                       for tokens in token_lists for token in tokens),
+                      dtype=np.int32)
+
+    offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(tokens) for tokens in token_lists])
+
+    arrays = _encode_strings(list(vocab), 'vocab')
+    arrays['token_ids'] = ids
+    arrays['token_offsets'] = offsets
+    return arrays
+
+
+def _decode_token_lists(arrays):
+    """Reverses `_encode_token_lists`."""
+    vocab = np.array(_decode_strings(arrays, 'vocab'), dtype=object)
+    ids = arrays['token_ids']
+    offsets = arrays['token_offsets']
+
+    return [vocab[ids[offsets[i]:offsets[i + 1]]].tolist()
+            for i in range(len(offsets) - 1)]
+
+
+def _is_string_list(values):
+    return all(isinstance(v, str) or v is None
+               or (isinstance(v, float) and np.isnan(v)) for v in values)
+
+
+def _encode_index(index):
+    """Encodes a Series index as (meta, arrays), or returns None if it can't
+    be stored and loaded back unchanged: object indexes must hold only
+    strings, and other indexes must be plain numeric, boolean or (timezone
+    naive) datetime arrays.
+    """
+    if isinstance(index, pd.MultiIndex):
+        return None
+    meta = {'index_name': index.name}
+    values = index.values
+    if not isinstance(values, np.ndarray):
+        # categorical, timezone aware, period and other extension indexes
+        return None
+
+    if values.dtype == object:
+        if not all(isinstance(label, str) for label in values):
+            return None
+        meta['index_kind'] = 'strings'
+        return meta, _encode_strings(list(values), 'index')
+    elif values.dtype.kind in 'iufbmM':
+        meta['index_kind'] = 'array'
+        return meta, {'index': values}
+    return None
+
+
+def _encode_result(result):
+    """Picks the storage layout for a result and encodes it as a dict of
+    numpy arrays, including a JSON `meta` entry. Returns None if the result
+    type isn't supported.
+    """
+    if isinstance(result, pd.Series) and _is_string_list(result.values):
+        encoded_index = _encode_index(result.index)
+        if encoded_index is None:
+            return None
+        meta = {'kind': 'series', 'name': result.name, **encoded_index[0]}
+        arrays = _encode_strings(list(result.values), 'text')
+        arrays.update(encoded_index[1])
+
+    elif isinstance(result, dict) and all(isinstance(tokens, list)
+                                          for tokens in result.values()):
+        meta = {'kind': 'dict_tokens',
+                'keys': [key.item() if isinstance(key, np.generic) else key
+                         for key in result.keys()]}
+        arrays = _encode_token_lists(list(result.values()))
+
+    elif isinstance(result, list) and all(isinstance(tokens, list)
+                                          for tokens in result):
+        meta = {'kind': 'tokens'}
+        arrays = _encode_token_lists(result)
+
+    elif isinstance(result, list) and _is_string_list(result):
+        meta = {'kind': 'text'}
+        arrays = _encode_strings(result, 'text')
+
+    else:
+        return None
+
+    try:
+        arrays['meta'] = np.array(json.dumps(meta))
+    except TypeError:
+        # keys or names that can't be stored as JSON
+        return None
+    return arrays
+
+
+def _decode_result(meta, arrays):
+    """Rebuilds a result from the arrays written by `_encode_result`."""
+    if meta['kind'] == 'series':
+        if meta['index_kind'] == 'strings':
+            index = _decode_strings(arrays, 'index')
+        else:
+            index = arrays['index']
+        return pd.Series(_decode_strings(arrays, 'text'),
+                         index=pd.Index(index, name=meta.get('index_name')),
+                         name=meta['name'], dtype=object)
+    elif meta['kind'] == 'dict_tokens':
+        return dict(zip(meta['keys'], _decode_token_lists(arrays)))
+    elif meta['kind'] == 'tokens':
+        return _decode_token_lists(arrays)
+    else:
+        return _decode_strings(arrays, 'text')
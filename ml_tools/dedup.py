@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+
+# Keys the Facebook posts are checked for duplicates on in
+# data_gathering.ipynb, each marked in `dupes_on_<key>` (all copies) and
+# `dupe_<key>_child` (all but the first copy) columns
+DEDUP_KEYS = {'link': ['trim_link', 'status_type'],
+              'desc': ['description'],
+              'name': ['name']}
+
+# combined codes of two columns are `left * _CODE_BASE + right`
+_CODE_BASE = 2 ** 31
+
+
+def _global_codes(values, uniques):
+    """Factorizes `values` (missing values get their own code) and maps the
+    codes onto `uniques`, a pandas Index of values already seen, which new
+    values are appended to.
+
+    Returns the codes, which stay the same for a value across calls, whether
+    each value is the first of its value in `values`, and the updated
+    `uniques`.
+    """
+    codes, batch_uniques = pd.factorize(values, use_na_sentinel=False)
+    # factorize numbers values in order of appearance, so a value is new
+    # where its code is higher than any before it
+    is_first = np.diff(np.maximum.accumulate(codes), prepend=-1) > 0
+
+    # same dtype as `uniques` (object for column values, int64 for combined
+    # codes), so appending never upcasts
+    batch_uniques = pd.Index(np.asarray(batch_uniques, dtype=uniques.dtype),
+                             dtype=uniques.dtype)
+    mapping = uniques.get_indexer(batch_uniques)
+    is_new = mapping == -1
+    mapping[is_new] = np.arange(len(uniques), len(uniques) + is_new.sum())
+    if is_new.any():
+        uniques = uniques.append(batch_uniques[is_new])
+    return mapping[codes], is_first, uniques
+
+
+class DuplicateIndex():
+    """Finds duplicate posts on several keys at once, replacing the
+    `df.duplicated(...)` passes of data_gathering.ipynb (two per key).
+
+    Each column is hashed once per row, with `pd.factorize`, into integer
+    codes that are kept, along with the number of rows in each duplicate
+    group (cluster) and whether each row was the first in its cluster.
+    Duplicate flags for every key are then read from those arrays, and new
+    posts can be appended without hashing the earlier ones again.
+
+    As in the notebook, rows missing the first column of a key (i.e.
+    `trim_link`) are never duplicates on that key; missing values in other
+    columns count as equal.
+
+    *** Arguments
+
+    keys: dictionary, default `DEDUP_KEYS`. Key name to the list of columns
+    identifying a duplicate. Flag columns are named `dupes_on_<key>` and
+    `dupe_<key>_child`.
+
+    *** Example
+
+    dupes = DuplicateIndex().append(df)
+    df = df.join(dupes.flags())
+    dupes.append(df_new)                 # only the new posts are hashed
+    dupes.duplicates_of('desc', post_index_label)
+    """
+
+    def __init__(self, keys=DEDUP_KEYS):
+        self.keys = {name: list(cols) for name, cols in keys.items()}
+        self.index = pd.Index([])
+        # per key: cluster code of each row (-1 if not checked), whether
+        # each row is the first of its cluster, and the size of each cluster
+        self.codes = {name: np.zeros(0, dtype=np.int64) for name in self.keys}
+        self.first = {name: np.zeros(0, dtype=bool) for name in self.keys}
+        self.sizes = {name: np.zeros(0, dtype=np.int64) for name in self.keys}
+        # per key: seen values of each column, and seen combinations of
+        # codes for each column after the first
+        self._uniques = {name: [pd.Index([], dtype=object) for col in cols]
+                         for name, cols in self.keys.items()}
+        self._combos = {name: [pd.Index([], dtype=np.int64) for col in cols]
+                        for name, cols in self.keys.items()}
+        # per key: code of the missing value in the first column, once seen
+        self._missing_code = {name: None for name in self.keys}
+        self._order = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _key_codes(self, df, name):
+        """Returns the cluster code of each row of `df` on key `name`, and
+        whether each row is the first of its cluster in `df`.
+        """
+        cols = self.keys[name]
+        uniques = self._uniques[name]
+        combos = self._combos[name]
+
+        n_seen = len(uniques[0])
+        codes, is_first, uniques[0] = _global_codes(df[cols[0]], uniques[0])
+        if self._missing_code[name] is None:
+            # only values new in this batch need checking; missing values
+            # all share one code
+            new_missing = np.flatnonzero(uniques[0][n_seen:].isna())
+            if len(new_missing) > 0:
+                self._missing_code[name] = n_seen + new_missing[0]
+        # rows missing the first column are never duplicates
+        if self._missing_code[name] is None:
+            is_missing = np.zeros(len(codes), dtype=bool)
+        else:
+            is_missing = codes == self._missing_code[name]
+
+        for i in range(1, len(cols)):
+            col_codes, _, uniques[i] = _global_codes(df[cols[i]], uniques[i])
+            codes, is_first, combos[i] = _global_codes(
+                codes * _CODE_BASE + col_codes, combos[i])
+        codes = codes.astype(np.int64)
+        codes[is_missing] = -1
+        return codes, is_first & ~is_missing
+
+    def append(self, df):
+        """Adds posts to the index. Their index labels identify them in
+        `flags`, `clusters` and `duplicates_of`, so should be unique.
+        """
+        for name in self.keys:
+            codes, is_first = self._key_codes(df, name)
+            checked = codes >= 0
+
+            sizes = self.sizes[name]
+            n_clusters = max(len(sizes), int(codes.max(initial=-1)) + 1)
+            sizes = np.concatenate([sizes, np.zeros(n_clusters - len(sizes),
+                                                    dtype=np.int64)])
+
+            # first of its cluster if it's the first in this batch, and the
+            # cluster was empty before it
+            first = np.zeros(len(codes), dtype=bool)
+            first[is_first] = sizes[codes[is_first]] == 0
+
+            sizes += np.bincount(codes[checked], minlength=n_clusters)
+
+            self.codes[name] = np.concatenate([self.codes[name], codes])
+            self.first[name] = np.concatenate([self.first[name], first])
+            self.sizes[name] = sizes
+
+        self.index = self.index.append(df.index)
+        self._order = {}
+        return self
+
+    def _flag_arrays(self, name):
+        """Returns boolean arrays of whether each row has duplicates, and
+        whether it's a duplicate of an earlier row, on key `name`.
+        """
+        codes = self.codes[name]
+        checked = codes >= 0
+        is_dupe = np.zeros(len(codes), dtype=bool)
+        is_dupe[checked] = self.sizes[name][codes[checked]] > 1
+        return is_dupe, checked & ~self.first[name]
+
+    def flags(self, keys=None):
+        """Returns a dataframe with the index of the appended posts and, for
+        each key, `dupes_on_<key>` (1 for every copy of a duplicate) and
+        `dupe_<key>_child` (1 for all but the first copy) columns. Other
+        rows are missing, as in the notebook.
+        """
+        flags = {}
+        for name in keys if keys is not None else self.keys:
+            is_dupe, is_child = self._flag_arrays(name)
+            flags[f"dupes_on_{name}"] = np.where(is_dupe, 1, np.nan)
+            flags[f"dupe_{name}_child"] = np.where(is_child, 1, np.nan)
+        return pd.DataFrame(flags, index=self.index)
+
+    def clusters(self, name, min_size=2):
+        """Returns a dataframe of the posts in clusters of at least
+        `min_size` posts on key `name`, indexed by post, with the `cluster`
+        code, `cluster_size` and whether it's the `first` post of its
+        cluster, sorted by cluster.
+        """
+        codes = self.codes[name]
+        checked = codes >= 0
+        sizes = np.zeros(len(codes), dtype=np.int64)
+        sizes[checked] = self.sizes[name][codes[checked]]
+        keep = np.flatnonzero(sizes >= min_size)
+        keep = keep[np.argsort(codes[keep], kind='stable')]
+        return pd.DataFrame({'cluster': codes[keep],
+                             'cluster_size': sizes[keep],
+                             'first': self.first[name][keep]},
+                            index=self.index[keep])
+
+    def duplicates_of(self, name, label):
+        """Returns the index labels of the other posts in the same cluster
+        as the post with index label `label` on key `name`, first post
+        first. Empty if it has no duplicates.
+        """
+        if name not in self._order:
+            # positions sorted by cluster, and where each cluster starts
+            codes = self.codes[name]
+            order = np.argsort(codes, kind='stable')
+            starts = np.searchsorted(codes[order],
+                                     np.arange(len(self.sizes[name]) + 1))
+            self._order[name] = (order, starts)
+        order, starts = self._order[name]
+
+        pos = self.index.get_loc(label)
+        code = self.codes[name][pos]
+        if code < 0:
+            return self.index[:0]
+        members = order[starts[code]:starts[code + 1]]
+        return self.index[members[members != pos]]
+
+
+def mark_duplicates(df, keys=DEDUP_KEYS):
+    """Adds the duplicate flag columns of `DuplicateIndex.flags` to `df`
+    (`dupes_on_link`, `dupe_link_child`, `dupes_on_desc`, ...), hashing
+    each column once. Returns `df`.
+    """
+    flags = DuplicateIndex(keys).append(df).flags()
+    for col in flags.columns:
+        df[col] = flags[col].values
+    return df
@@ -2,10 +2,78 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+from scipy import stats
+
+
+def _corr_with_target(X, y):
+    """Pearson correlation of each column of 2-D array `X` with `y`, using
+    only the rows where both are present, like `df.corr()`. Returns NaN
+    for columns with fewer than 2 such rows or no variance.
+    """
+    valid = ~np.isnan(X) & ~np.isnan(y)[:, None]
+    counts = valid.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = np.where(valid, X, 0).sum(axis=0) / counts
+        y_mean = np.where(valid, y[:, None], 0).sum(axis=0) / counts
+        dx = np.where(valid, X - x_mean, 0)
+        dy = np.where(valid, y[:, None] - y_mean, 0)
+        corr = (dx * dy).sum(axis=0) / np.sqrt((dx ** 2).sum(axis=0) *
+                                               (dy ** 2).sum(axis=0))
+    corr[counts < 2] = np.nan
+    return np.clip(corr, -1, 1)
+
+
+def _explore_cont_stats(to_explore, df, target, norm_check=True,
+                        block_size=256):
+    """Builds the metadata table of `explore_data_cont` for all its numeric
+    columns at once, without printing or plotting.
+    """
+    num_cols = [col for col in to_explore
+                if df[col].dtype in ['int64', 'float64']]
+    y = df[target].to_numpy(dtype=np.float64)
+
+    num_uniques = df[num_cols].nunique(dropna=False)
+    corrs, k2s, ps, means, medians = [], [], [], [], []
+
+    # work through the columns in blocks to limit memory use
+    for start in range(0, len(num_cols), block_size):
+        block = num_cols[start:start + block_size]
+        X = df[block].to_numpy(dtype=np.float64)
+
+        corrs.append(_corr_with_target(X, y))
+        means.append(np.nanmean(X, axis=0) if len(X) > 0
+                     else np.full(len(block), np.nan))
+        # np.median of a column with missing values is NaN, as before
+        medians.append(np.median(X, axis=0) if len(X) > 0
+                       else np.full(len(block), np.nan))
+        if norm_check:
+            k2, p = stats.normaltest(X, axis=0)
+            k2s.append(np.atleast_1d(k2))
+            ps.append(np.atleast_1d(p))
+
+    def joined(arrays):
+        return np.concatenate(arrays) if len(arrays) > 0 else np.array([])
+
+    uniques = num_uniques.values
+    categorical = uniques < 20
+    df_meta = pd.DataFrame({
+        'col_name': num_cols,
+        'corr_target': joined(corrs),
+        'assumed_var_type': np.where(categorical, 'categorical',
+                                     'continuous'),
+        'omnibus_k2': joined(k2s) if norm_check else None,
+        'omnibus_pstat': joined(ps) if norm_check else None,
+        'is_normal': ~(joined(ps) < 0.05) if norm_check else None,
+        'uniques': np.where(categorical, uniques, np.nan),
+        'mean': np.where(categorical, np.nan, joined(means)),
+        'median': np.where(categorical, np.nan, joined(medians))})
+    return df_meta
 
 
 def explore_data_cont(to_explore, df, target, hist=True, box=True, plot_v_target=True,
-                 summarize=True, norm_check=True):
+                 summarize=True, norm_check=True, stats_only=False,
+                 max_plot_rows=None):
     """Creates plots and summary information intended to be useful in preparing
     for linear regression modeling. 
     Prints plots of distributions, a scatterplot of each predictor column against 
@@ -46,7 +114,27 @@ def explore_data_cont(to_explore, df, target, hist=True, box=True, plot_v_target
     check using SciPy's stats omnibus normality test. Null hypothesis 
     is that the data comes from a normal distribution, so a value less than
     0.05 represents likely NOT normal data.
+
+    stats_only: True or False (default False). Whether to skip all printing
+    and plotting and only return the metadata dataframe, computed for all
+    numeric columns at once rather than column by column. Much faster with
+    many columns; plot the interesting ones afterwards by passing just
+    those columns.
+
+    max_plot_rows: int (optional). Plots use a random sample of this many
+    rows for larger dataframes. Metadata always uses every row.
     """
+    if stats_only:
+        if type(to_explore) == str:
+            to_explore = [to_explore]
+        return _explore_cont_stats(to_explore, df, target,
+                                   norm_check=norm_check)
+
+    # plot a sample of large dataframes, since plotting every point is slow
+    # and doesn't change the picture
+    df_plot = df
+    if max_plot_rows is not None and len(df) > max_plot_rows:
+        df_plot = df.sample(max_plot_rows, random_state=42)
     
     # Create some variables to dynamically handle including/excluding 
     # certain charts
@@ -151,12 +239,12 @@ def explore_data_cont(to_explore, df, target, hist=True, box=True, plot_v_target
 
                 # Histogram
                 if hist:
-                    sns.histplot(df[col], kde=True, ax=ax1)
+                    sns.histplot(df_plot[col], kde=True, ax=ax1)
                     ax1.set_title(f"Hist {col}")
 
                 # Box plot
                 if box:
-                    sns.boxplot(x=df[col], ax=ax2)
+                    sns.boxplot(x=df_plot[col], ax=ax2)
                     ax2.set_title(f"Boxplot {col}")
 
                 # Plot against target
@@ -165,17 +253,19 @@ def explore_data_cont(to_explore, df, target, hist=True, box=True, plot_v_target
                     if var_type == 'continuous':
                         try:
                             quartile_labels=['q1', 'q2', 'q3', 'q4']
-                            quartiles = pd.qcut(df[col], 4, 
+                            quartiles = pd.qcut(df_plot[col], 4, 
                                                 labels=quartile_labels, 
                                                 duplicates='drop')
-                            sns.scatterplot(x=df[col], y=df[target], ax=ax3, 
-                                            hue=quartiles)
+                            sns.scatterplot(x=df_plot[col], y=df_plot[target],
+                                            ax=ax3, hue=quartiles)
                             ax3.legend(title=f'{col} quartiles')
                             
                         except:
-                            sns.scatterplot(x=df[col], y=df[target], ax=ax3)
+                            sns.scatterplot(x=df_plot[col], y=df_plot[target],
+                                            ax=ax3)
                     else:
-                        sns.scatterplot(x=df[col], y=df[target], ax=ax3)
+                        sns.scatterplot(x=df_plot[col], y=df_plot[target],
+                                        ax=ax3)
                     ax3.set_title(f"{col} versus {target}")
                     
                 plt.show();
@@ -213,7 +303,7 @@ def explore_data_cont(to_explore, df, target, hist=True, box=True, plot_v_target
             order.sort()
             
             fig, ax = plt.subplots(figsize=(8, (h*0.15)+4))
-            sns.barplot(x=target, y=col, data=df, orient='h', 
+            sns.barplot(x=target, y=col, data=df_plot, orient='h', 
                         order=order, ax=ax)
             ax.set_title(f"Average {target} per {col}");
             plt.show();
@@ -302,53 +392,138 @@ def currency(x, pos=None):
         return '${:.1f}'.format(x)
 
 
-def mark_outliers(df, outlier_col, mark_col, method='iqr'):
+def _outlier_cutoffs(X, method, k, lower_pct, upper_pct):
+    """Lower and upper outlier cutoffs for each column of 2-D array `X`,
+    ignoring missing values.
+    """
+    if method == 'iqr':
+        q1, q3 = np.nanpercentile(X, [25, 75], axis=0)
+        iqr = q3 - q1
+        return q1 - (iqr * k), q3 + (iqr * k)
+    elif method == 'mad':
+        median = np.nanmedian(X, axis=0)
+        # scaled so it estimates the standard deviation of normal data
+        mad = np.nanmedian(np.abs(X - median), axis=0) * 1.4826
+        return median - (mad * k), median + (mad * k)
+    else:
+        return np.nanpercentile(X, [lower_pct, upper_pct], axis=0)
+
+
+def _grouped_outlier_cutoffs(df, cols, groupby, method, k, lower_pct,
+                             upper_pct):
+    """Like `_outlier_cutoffs`, but calculated separately for each group,
+    and returned as arrays with one row per row of `df`. Rows with a missing
+    group get NaN cutoffs, so are never outliers.
+    """
+    grouped = df.groupby(groupby)
+    # missing groups are numbered -1, or NaN in some pandas versions
+    codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    has_group = codes >= 0
+
+    def per_row(group_values):
+        # spread one row per group out to one row per row of df
+        values = np.full((len(df), len(cols)), np.nan)
+        values[has_group] = group_values.to_numpy(dtype=np.float64)[
+            codes[has_group]]
+        return values
+
+    if method == 'iqr':
+        quantiles = grouped[cols].quantile([0.25, 0.75])
+        q1 = per_row(quantiles.xs(0.25, level=-1))
+        q3 = per_row(quantiles.xs(0.75, level=-1))
+        iqr = q3 - q1
+        return q1 - (iqr * k), q3 + (iqr * k)
+    elif method == 'mad':
+        median = per_row(grouped[cols].median())
+        deviations = pd.DataFrame(
+            np.abs(df[cols].to_numpy(dtype=np.float64) - median)[has_group],
+            columns=cols)
+        mad = per_row(deviations.groupby(codes[has_group]).median()) * 1.4826
+        return median - (mad * k), median + (mad * k)
+    else:
+        quantiles = grouped[cols].quantile([lower_pct / 100, upper_pct / 100])
+        return (per_row(quantiles.xs(lower_pct / 100, level=-1)),
+                per_row(quantiles.xs(upper_pct / 100, level=-1)))
+
+
+def mark_outliers(df, outlier_col, mark_col, method='iqr', k=None,
+                  lower_pct=1, upper_pct=99, groupby=None, verbose=True):
     """Mark outliers so they can be excluded from exploration and visualization,
     but not dropped from the data frame completely.
     
-    Only IQR method supported at this time.
+    All columns are checked at once, and outliers are marked with a value of
+    1 in the mark column, which is only created if there are outliers.
+    Missing values are ignored, and never marked.
     
     Arguments:
     
     df = Dataframe that contains the columns to be assessed for outliers
     
-    outlier_col = string. The name of the column to be checked for outliers.
-    
-    mark_col = string. The name of the new column to create in `df` to mark
-    outliers with a value of 1.
-    """
-    
-    # isolate the column as a series
-    col = df[outlier_col]
+    outlier_col = string, or list of strings. The name(s) of the column(s) to
+    be checked for outliers, i.e. `['likes_count', 'comments_count',
+    'shares_count']`.
     
-    if method == 'iqr':
-        # determine outlier cutoff points based on iqr
-        q1 = np.percentile(col, 25)
-        q3 = np.percentile(col, 75)
-        iqr = q3 - q1
-        under = q1 - (iqr * 1.5)
-        over = q3 + (iqr * 1.5)
-        
-        # determine how many rows, if any, will be dropped for each cutoff
-        under_drop = len(df.loc[df[outlier_col] < under, outlier_col])
-        over_drop = len(df.loc[df[outlier_col] > over, outlier_col])
-        
-        if under_drop > 0 or over_drop > 0:
-            
-            print(f"Number of lower outliers to mark: {under_drop}")
-            print(f"Number of upper outliers to mark: {over_drop}")
+    mark_col = string, or list of strings. The name of the new column to
+    create in `df` to mark outliers with a value of 1. Give one per
+    `outlier_col` to mark each separately, or one name to mark rows that are
+    outliers in any of them.
 
-            if under_drop > 0:
-                df.loc[df[outlier_col] < under, mark_col] = 1
+    method = string, default `iqr`.
+    - `iqr`: more than `k` (default 1.5) IQRs below the 1st or above the 3rd
+    quartile
+    - `mad`: more than `k` (default 3.5) scaled median absolute deviations
+    from the median; less affected by long tails than IQR
+    - `percentile`: below the `lower_pct` or above the `upper_pct`
+    percentile
 
-            if over_drop > 0:
-                df.loc[df[outlier_col] > over, mark_col] = 1
+    groupby = string, or list of strings (optional). Column(s) to calculate
+    cutoffs within, i.e. `post_type` or `year`, instead of across the whole
+    dataframe.
 
-            return df
+    verbose = boolean, default True. Whether to print how many outliers
+    were marked.
 
-        else:
-            print("No outliers identified.")
-        
-        
+    Returns `df`.
+    """
+    if method not in ['iqr', 'mad', 'percentile']:
+        print("Error: method must be 'iqr', 'mad' or 'percentile'.")
+        return None
+    if k is None:
+        k = 3.5 if method == 'mad' else 1.5
+
+    cols = [outlier_col] if type(outlier_col) == str else list(outlier_col)
+    marks = [mark_col] * len(cols) if type(mark_col) == str \
+        else list(mark_col)
+    if len(marks) != len(cols):
+        print("Error: give one `mark_col`, or one per `outlier_col`.")
+        return None
+
+    X = df[cols].to_numpy(dtype=np.float64)
+    if groupby is None:
+        under, over = _outlier_cutoffs(X, method, k, lower_pct, upper_pct)
     else:
-        print("Error: Only iqr method is supported at this time.")
+        under, over = _grouped_outlier_cutoffs(df, cols, groupby, method, k,
+                                               lower_pct, upper_pct)
+
+    # comparisons with NaN are False, so missing values are never outliers
+    with np.errstate(invalid='ignore'):
+        is_under = X < under
+        is_over = X > over
+
+    combined = {}
+    for i, (col, mark) in enumerate(zip(cols, marks)):
+        if verbose:
+            print(f"{col}: Number of lower outliers to mark: "
+                  f"{is_under[:, i].sum()}")
+            print(f"{col}: Number of upper outliers to mark: "
+                  f"{is_over[:, i].sum()}")
+        mask = is_under[:, i] | is_over[:, i]
+        combined[mark] = combined.get(mark, False) | mask
+
+    for mark, mask in combined.items():
+        if mask.any():
+            df.loc[mask, mark] = 1
+        elif verbose:
+            print(f"No outliers identified for {mark}.")
+
+    return df
@@ -0,0 +1,311 @@
+import json
+import numpy as np
+import pandas as pd
+
+# Engagement metrics combined into the single engagement score
+ENGAGEMENT_COLS = ['likes_count', 'comments_count', 'shares_count']
+
+
+class QuantileSketch():
+    """Mergeable streaming sketch of a distribution of non-negative values,
+    i.e. like or share counts, for quantiles and percentile ranks without
+    keeping the values.
+
+    Values are counted in logarithmic buckets, so any quantile is within
+    `relative_accuracy` of the true value (1% by default) however skewed
+    the distribution is, and zeros are counted exactly. Sketches with the
+    same accuracy merge by adding bucket counts, so per-window sketches can
+    be combined into any longer period.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self._gamma)
+        self.zero_count = 0
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    @property
+    def count(self):
+        return self.zero_count + int(self.counts.sum())
+
+    def _bucket(self, values):
+        return np.ceil(np.log(values) / self._log_gamma).astype(np.int64)
+
+    def _bucket_values(self):
+        # the value each bucket represents, with error at most
+        # `relative_accuracy` for any value in the bucket
+        idx = np.arange(self.offset, self.offset + len(self.counts))
+        return 2 * self._gamma ** idx / (self._gamma + 1)
+
+    def _grow(self, lo, hi):
+        """Makes room for bucket indexes `lo` to `hi`."""
+        if len(self.counts) == 0:
+            self.offset = lo
+            self.counts = np.zeros(hi - lo + 1, dtype=np.int64)
+            return
+        new_lo = min(lo, self.offset)
+        new_hi = max(hi, self.offset + len(self.counts) - 1)
+        if new_lo == self.offset and new_hi - new_lo + 1 == len(self.counts):
+            return
+        counts = np.zeros(new_hi - new_lo + 1, dtype=np.int64)
+        start = self.offset - new_lo
+        counts[start:start + len(self.counts)] = self.counts
+        self.offset, self.counts = new_lo, counts
+
+    def update(self, values):
+        """Adds values to the sketch. Missing and negative values are
+        ignored.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values) & (values >= 0)]
+        self.zero_count += int((values == 0).sum())
+
+        positive = values[values > 0]
+        if len(positive) == 0:
+            return self
+        buckets = self._bucket(positive)
+        lo, hi = buckets.min(), buckets.max()
+        self._grow(lo, hi)
+        self.counts += np.bincount(buckets - self.offset,
+                                   minlength=len(self.counts))
+        return self
+
+    def merge(self, other):
+        """Adds another sketch's counts to this one."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same relative_accuracy "
+                             "can be merged.")
+        self.zero_count += other.zero_count
+        if len(other.counts) > 0:
+            self._grow(other.offset, other.offset + len(other.counts) - 1)
+            start = other.offset - self.offset
+            self.counts[start:start + len(other.counts)] += other.counts
+        return self
+
+    def quantile(self, q):
+        """Returns the value at quantile(s) `q`, between 0 and 1. NaN if the
+        sketch is empty.
+        """
+        q = np.asarray(q, dtype=np.float64)
+        total = self.count
+        if total == 0:
+            return np.full(q.shape, np.nan) if q.ndim else np.nan
+
+        # zero-based rank of the value at each quantile, with 'lower'
+        # interpolation, then the bucket holding that rank
+        ranks = np.floor(q * (total - 1))
+        cum = self.zero_count + np.cumsum(self.counts)
+        idx = np.minimum(np.searchsorted(cum, ranks, side='right'),
+                         max(len(self.counts) - 1, 0))
+
+        values = np.zeros(q.shape)
+        nonzero = ranks >= self.zero_count
+        if nonzero.any():
+            values[nonzero] = self._bucket_values()[idx[nonzero]]
+        return values if q.ndim else float(values)
+
+    def percentile_rank(self, values):
+        """Returns the percentile rank (0 to 100) of each value among the
+        values in the sketch, like `Series.rank(pct=True)` with average
+        ties, where values in the same bucket count as ties. Missing and
+        negative values get NaN.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        total = self.count
+        if total == 0:
+            return np.full(values.shape, np.nan)
+
+        # number of values below each value, and tied with it
+        less = np.zeros(values.shape)
+        tied = np.full(values.shape, float(self.zero_count))
+
+        positive = values > 0
+        if positive.any():
+            n_buckets = len(self.counts)
+            cum = np.concatenate([[0], np.cumsum(self.counts)])
+            idx = self._bucket(values[positive]) - self.offset
+            in_range = (idx >= 0) & (idx < n_buckets)
+
+            less[positive] = self.zero_count + cum[np.clip(idx, 0, n_buckets)]
+            tied[positive] = 0
+            if n_buckets > 0:
+                tied[positive] = np.where(
+                    in_range, self.counts[np.clip(idx, 0, n_buckets - 1)], 0)
+
+        with np.errstate(invalid='ignore'):
+            ranks = (less + (tied + 1) / 2) / total * 100
+            ranks[np.isnan(values) | (values < 0)] = np.nan
+        return np.minimum(ranks, 100)
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy,
+                'zero_count': self.zero_count, 'offset': int(self.offset),
+                'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['relative_accuracy'])
+        sketch.zero_count = d['zero_count']
+        sketch.offset = d['offset']
+        sketch.counts = np.array(d['counts'], dtype=np.int64)
+        return sketch
+
+
+class EngagementLabeler():
+    """Labels posts with engagement tiers, keeping a `QuantileSketch` of
+    each engagement metric per time window so new posts can be labeled
+    without recalculating percentiles over every earlier post.
+
+    As in the modeling data, each post's percentile rank is calculated for
+    each metric among posts in its window, and the mean of those is its
+    engagement score (`engagement_pct`, 0 to 100). Posts scoring over
+    `high_pct` are high engagement; `all_binary` is 1 for high and 0
+    otherwise, and `all_multi` is 2 for high, 0 for scores under `low_pct`
+    and 1 (moderate) otherwise.
+
+    *** Arguments
+
+    metric_cols: list, default `ENGAGEMENT_COLS`. Engagement count columns.
+
+    date_col: string, default `posted_at`. Datetime column used for windows.
+
+    window: string (optional), default 'Y'. pandas period frequency of the
+    windows percentiles are calculated within, i.e. 'Y', 'Q' or 'M'. One
+    window for all posts if None.
+
+    high_pct, low_pct: numbers, default 75 and 25. Engagement score cutoffs.
+
+    relative_accuracy: float, default 0.01. See `QuantileSketch`.
+
+    *** Example
+
+    labeler = EngagementLabeler(window='Y')
+    labels = labeler.label(df)            # first batch
+    new_labels = labeler.label(df_new)    # later batches update the sketches
+    labeler.cutoffs('2016')               # metric values at each percentile
+    """
+
+    def __init__(self, metric_cols=ENGAGEMENT_COLS, date_col='posted_at',
+                 window='Y', high_pct=75, low_pct=25,
+                 relative_accuracy=0.01):
+        self.metric_cols = list(metric_cols)
+        self.date_col = date_col
+        self.window = window
+        self.high_pct = high_pct
+        self.low_pct = low_pct
+        self.relative_accuracy = relative_accuracy
+        # {window: {metric col: QuantileSketch}}
+        self.sketches = {}
+
+    def _windows(self, df):
+        """Returns the window key of each post, as strings."""
+        if self.window is None:
+            return pd.Series('all', index=df.index)
+        dates = pd.to_datetime(df[self.date_col])
+        if getattr(dates.dt, 'tz', None) is not None:
+            dates = dates.dt.tz_localize(None)
+        return dates.dt.to_period(self.window).astype(str)
+
+    def update(self, df):
+        """Adds a batch of posts to the sketches of their windows."""
+        windows = self._windows(df)
+        for key, idx in windows.groupby(windows).groups.items():
+            sketches = self.sketches.setdefault(
+                key, {col: QuantileSketch(self.relative_accuracy)
+                      for col in self.metric_cols})
+            for col in self.metric_cols:
+                sketches[col].update(df.loc[idx, col].values)
+        return self
+
+    def label(self, df, update=True):
+        """Labels a batch of posts, adding them to the sketches first if
+        `update` is True. Set `update` to False to relabel posts that were
+        already added, i.e. after later batches changed their windows.
+
+        Returns a dataframe with the same index as `df`, with
+        `engagement_pct`, `all_binary` and `all_multi` columns. Posts whose
+        window has no sketch get missing labels.
+        """
+        if update:
+            self.update(df)
+
+        windows = self._windows(df)
+        score = pd.Series(np.nan, index=df.index)
+        for key, idx in windows.groupby(windows).groups.items():
+            if key not in self.sketches:
+                continue
+            ranks = np.column_stack([
+                self.sketches[key][col].percentile_rank(
+                    df.loc[idx, col].to_numpy(dtype=np.float64))
+                for col in self.metric_cols])
+            score[idx] = ranks.mean(axis=1)
+
+        labels = pd.DataFrame({'engagement_pct': score}, index=df.index)
+        labels['all_binary'] = (score > self.high_pct).astype('Int8')
+        labels['all_multi'] = pd.Series(
+            np.where(score > self.high_pct, 2,
+                     np.where(score < self.low_pct, 0, 1)),
+            index=df.index).astype('Int8')
+        labels.loc[score.isna(), ['all_binary', 'all_multi']] = pd.NA
+        return labels
+
+    def windows(self):
+        """Returns the windows that have sketches, in order."""
+        return sorted(self.sketches)
+
+    def merged_sketches(self, windows=None):
+        """Returns {metric col: QuantileSketch} merged over `windows` (a list
+        of window keys, i.e. `['2015', '2016']`), or over all windows.
+        """
+        if windows is None:
+            windows = self.windows()
+        merged = {col: QuantileSketch(self.relative_accuracy)
+                  for col in self.metric_cols}
+        for key in windows:
+            for col in self.metric_cols:
+                merged[col].merge(self.sketches[key][col])
+        return merged
+
+    def cutoffs(self, window=None, percentiles=None):
+        """Returns a dataframe of each metric's value (rows) at each
+        percentile (columns), by default `low_pct`, 50 and `high_pct`, for
+        one window (i.e. '2016'), a list of windows merged together, or all
+        windows if None. Doesn't read any posts.
+        """
+        if percentiles is None:
+            percentiles = [self.low_pct, 50, self.high_pct]
+        if window is None or isinstance(window, list):
+            sketches = self.merged_sketches(window)
+        else:
+            sketches = self.sketches[window]
+
+        q = np.asarray(percentiles, dtype=np.float64) / 100
+        return pd.DataFrame([sketches[col].quantile(q)
+                             for col in self.metric_cols],
+                            index=self.metric_cols, columns=percentiles)
+
+    def save(self, path):
+        """Saves the settings and sketches to a JSON file."""
+        state = {'metric_cols': self.metric_cols, 'date_col': self.date_col,
+                 'window': self.window, 'high_pct': self.high_pct,
+                 'low_pct': self.low_pct,
+                 'relative_accuracy': self.relative_accuracy,
+                 'sketches': {key: {col: sketch.to_dict()
+                                    for col, sketch in sketches.items()}
+                              for key, sketches in self.sketches.items()}}
+        with open(path, 'w') as f:
+            json.dump(state, f)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a labeler saved with `save`."""
+        with open(path, 'r') as f:
+            state = json.load(f)
+        sketches = state.pop('sketches')
+        labeler = cls(**state)
+        labeler.sketches = {key: {col: QuantileSketch.from_dict(d)
+                                  for col, d in window_sketches.items()}
+                            for key, window_sketches in sketches.items()}
+        return labeler
@@ -0,0 +1,640 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
+import requests
+
+ARCHIVE_URL = 'https://api.nytimes.com/svc/archive/v1'
+
+
+class RateLimiter():
+    """Thread-safe token bucket rate limiter.
+
+    `rate` is the number of requests allowed per second on average, and
+    `capacity` is how many requests can be made in a burst after being idle.
+    The NYT APIs allow 10 requests per minute, i.e. `rate=10/60`.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def request_with_retry(session, method, url, limiter=None, max_retries=5,
+                       backoff=2.0, timeout=30, **kwargs):
+    """Makes an HTTP request, retrying with exponential backoff on connection
+    errors, timeouts, rate limiting (429) and server errors (5xx).
+
+    Waits on `limiter` (a `RateLimiter`) before every attempt, if provided.
+    Extra keyword arguments are passed to `session.request`.
+
+    Returns the response. Raises the last error if every attempt failed.
+    """
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            resp = session.request(method, url, timeout=timeout, **kwargs)
+            if resp.status_code == 429 or resp.status_code >= 500:
+                resp.raise_for_status()
+            return resp
+        except requests.RequestException:
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff ** attempt)
+
+
+def _archive_checkpoint_path(checkpoint_dir, year, month):
+    return os.path.join(checkpoint_dir, f"archive_{year}_{month:02d}.json.gz")
+
+
+def _write_json_gz(obj, path):
+    """Writes `obj` to a gzipped JSON file, via a temp file so an interrupted
+    write never leaves a partial checkpoint behind.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    suffix='.tmp')
+    os.close(fd)
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def fetch_archive(api_key, years, months, checkpoint_dir, base_url=ARCHIVE_URL,
+                  max_workers=2, rate=10/60, max_retries=5, backoff=2.0,
+                  timeout=60, verbose=True):
+    """Downloads article metadata from the NYT Archive API for every year and
+    month requested, saving each month to its own checkpoint file in
+    `checkpoint_dir` as soon as it's downloaded.
+
+    Months that already have a checkpoint are skipped, so an interrupted run
+    can be restarted with the same arguments and will pick up where it left
+    off. Use `load_archive` to read the checkpoints back in.
+
+    Returns a dictionary with lists of the (year, month) pairs that were
+    `fetched`, `skipped` (already checkpointed) and `failed`.
+
+    *** Arguments
+
+    api_key: string. NYT developer API key.
+
+    years, months: lists of ints. Every combination is downloaded.
+
+    checkpoint_dir: string. Directory for the per-month checkpoint files.
+    Created if it doesn't exist.
+
+    base_url: string. Archive API endpoint; can be pointed at a local stub
+    server for testing.
+
+    max_workers: int, default 2. Number of months downloaded concurrently.
+    Archive responses are large, so a couple of workers keeps the rate
+    limiter busy while responses download.
+
+    rate: float, default 10/60. Maximum requests per second across all
+    workers, including retries.
+
+    max_retries, backoff, timeout: see `request_with_retry`.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    limiter = RateLimiter(rate)
+    local = threading.local()
+    summary = {'fetched': [], 'skipped': [], 'failed': []}
+
+    def fetch_month(year, month):
+        # requests sessions aren't thread-safe, so one per worker thread
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+
+        url = f"{base_url}/{year}/{month}.json"
+        resp = request_with_retry(local.session, 'GET', url, limiter=limiter,
+                                  max_retries=max_retries, backoff=backoff,
+                                  timeout=timeout, params={'api-key': api_key})
+        resp.raise_for_status()
+        docs = resp.json()['response']['docs']
+
+        _write_json_gz(docs, _archive_checkpoint_path(checkpoint_dir, year,
+                                                      month))
+        return len(docs)
+
+    to_fetch = []
+    for year in years:
+        for month in months:
+            month = int(month)
+            if os.path.exists(_archive_checkpoint_path(checkpoint_dir, year,
+                                                       month)):
+                summary['skipped'].append((year, month))
+            else:
+                to_fetch.append((year, month))
+
+    if verbose and len(summary['skipped']) > 0:
+        print(f"Skipping {len(summary['skipped'])} months already downloaded")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_month, year, month): (year, month)
+                   for year, month in to_fetch}
+
+        for future in as_completed(futures):
+            year, month = futures[future]
+            try:
+                article_count = future.result()
+            except Exception as e:
+                summary['failed'].append((year, month))
+                if verbose:
+                    # error messages can include the request URL
+                    error = str(e).replace(api_key, '<api-key>')
+                    print(f"Error fetching {month}, {year}: {error}")
+            else:
+                summary['fetched'].append((year, month))
+                if verbose:
+                    print(f"Returned {article_count} articles from {month}, "
+                          f"{year}")
+
+    summary['fetched'].sort()
+    summary['failed'].sort()
+    return summary
+
+
+def load_archive(years, months, checkpoint_dir):
+    """Loads the per-month checkpoints written by `fetch_archive` into one
+    list of article dictionaries, in year and month order, matching the list
+    the archive download in data_gathering.ipynb builds.
+
+    Months without a checkpoint are reported and skipped.
+    """
+    articles = []
+    for year in years:
+        for month in months:
+            path = _archive_checkpoint_path(checkpoint_dir, year, int(month))
+            if not os.path.exists(path):
+                print(f"No checkpoint for {month}, {year}")
+                continue
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                articles.extend(json.load(f))
+    return articles
+
+
+def load_link_store(store_path):
+    """Reads the append-only link store written by `expand_links`.
+
+    Returns two dictionaries: short link to expanded link for every link
+    that has been expanded, and short link to error message for links whose
+    most recent attempt failed.
+    """
+    expanded = {}
+    failed = {}
+    if not os.path.exists(store_path):
+        return expanded, failed
+
+    with open(store_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # partial last line from an interrupted run
+                continue
+            if record.get('expanded') is not None:
+                expanded[record['url']] = record['expanded']
+                failed.pop(record['url'], None)
+            else:
+                failed[record['url']] = record.get('error')
+    return expanded, failed
+
+
+def _expand_link(session, url, limiter, max_retries, backoff, timeout):
+    """Follows redirects from `url` and returns the final URL. Falls back to
+    a streamed GET for servers that don't accept HEAD requests.
+    """
+    resp = request_with_retry(session, 'HEAD', url, limiter=limiter,
+                              max_retries=max_retries, backoff=backoff,
+                              timeout=timeout, allow_redirects=True)
+    if resp.status_code == 405:
+        resp = request_with_retry(session, 'GET', url, limiter=limiter,
+                                  max_retries=max_retries, backoff=backoff,
+                                  timeout=timeout, allow_redirects=True,
+                                  stream=True)
+        resp.close()
+    return resp.url
+
+
+def expand_links(urls, store_path, max_workers=16, rate=None, max_retries=2,
+                 backoff=2.0, timeout=10, retry_failed=True, verbose=True):
+    """Expands shortened links (i.e. `nyti.ms`) by following their redirects,
+    using a pool of worker threads that each keep a pooled HTTP session.
+
+    Links are deduplicated first, and links already expanded in the store
+    at `store_path` are never requested again. Each result is appended to
+    the store as a JSON line as soon as it completes, so the store persists
+    across runs and an interrupted run loses nothing. Failures are recorded
+    in the store with their error, and retried on the next run.
+
+    Returns a dictionary of short link to expanded link for every link in
+    `urls` that has been expanded, including in earlier runs. Use
+    `load_link_store` to see which links failed.
+
+    *** Arguments
+
+    urls: iterable of strings. Links to expand; duplicates and missing
+    values are ignored.
+
+    store_path: string. Path of the JSON lines store file.
+
+    max_workers: int, default 16. Number of concurrent requests.
+
+    rate: float (optional). Maximum requests per second across all workers.
+    No limit if None.
+
+    retry_failed: Boolean, default True. Whether to retry links that failed
+    in an earlier run.
+
+    max_retries, backoff, timeout: see `request_with_retry`.
+    """
+    expanded, failed = load_link_store(store_path)
+
+    to_expand = []
+    seen = set()
+    for url in urls:
+        if not isinstance(url, str) or url in seen:
+            continue
+        seen.add(url)
+        if url in expanded or (url in failed and not retry_failed):
+            continue
+        to_expand.append(url)
+
+    if verbose:
+        print(f"{len(seen)} unique links, {len(to_expand)} to expand")
+
+    limiter = RateLimiter(rate, capacity=max_workers) if rate else None
+    local = threading.local()
+
+    def expand(url):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+            local.session.mount('http://', adapter)
+            local.session.mount('https://', adapter)
+        return _expand_link(local.session, url, limiter, max_retries,
+                            backoff, timeout)
+
+    count = 0
+    with open(store_path, 'a', encoding='utf-8') as store, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(expand, url): url for url in to_expand}
+
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                record = {'url': url, 'expanded': future.result()}
+                expanded[url] = record['expanded']
+            except Exception as e:
+                record = {'url': url, 'expanded': None, 'error': str(e)}
+                failed[url] = record['error']
+                if verbose:
+                    print(f"Error expanding {url}: {e}")
+
+            store.write(json.dumps(record) + '\n')
+            store.flush()
+
+            count += 1
+            if verbose and count % 500 == 0:
+                print(f"{count} links processed")
+
+    return {url: expanded[url] for url in seen if url in expanded}
+
+
+# id of the comment count bubble on NYT article pages
+COMMENT_BUBBLE_ID = 'comments-speech-bubble-top'
+
+
+class _CommentBubbleParser(HTMLParser):
+    """Collects the text of every element with the comment bubble id."""
+
+    def __init__(self):
+        super().__init__()
+        self.bubbles = []
+        self._depth = 0
+
+    # elements without end tags, which don't change the depth
+    VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                 'link', 'meta', 'source', 'track', 'wbr'}
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.VOID_TAGS:
+            return
+        if self._depth > 0:
+            self._depth += 1
+        elif dict(attrs).get('id') == COMMENT_BUBBLE_ID:
+            self._depth = 1
+            self.bubbles.append('')
+
+    def handle_endtag(self, tag):
+        if self._depth > 0 and tag not in self.VOID_TAGS:
+            self._depth -= 1
+
+    def handle_data(self, data):
+        if self._depth > 0:
+            self.bubbles[-1] += data
+
+
+# element with the bubble id and its contents, for the regex engine
+_BUBBLE_RE = re.compile(
+    rb'<([a-z][a-z0-9-]*)\b[^>]*?\bid\s*=\s*["\']'
+    + COMMENT_BUBBLE_ID.encode() + rb'["\'][^>]*>(.*?)</\1\s*>',
+    re.S | re.I)
+_TAG_RE = re.compile(rb'<[^>]*>')
+
+
+def _bubble_texts(html, engine):
+    """Returns the text of each comment bubble element in `html`."""
+    if engine == 'regex':
+        if isinstance(html, str):
+            html = html.encode('utf-8', errors='replace')
+        # most pages are skipped by this substring check alone
+        if COMMENT_BUBBLE_ID.encode() not in html:
+            return []
+        return [_TAG_RE.sub(b'', match.group(2)).decode('utf-8', 'replace')
+                for match in _BUBBLE_RE.finditer(html)]
+
+    if isinstance(html, bytes):
+        html = html.decode('utf-8', errors='replace')
+    parser = _CommentBubbleParser()
+    parser.feed(html)
+    parser.close()
+    return parser.bubbles
+
+
+_COUNT_RE = re.compile(r'(\d+(?:\.\d+)?)\s*([KkMm]?)')
+_COUNT_SCALES = {'': 1, 'k': 1000, 'm': 1000000}
+
+
+def _parse_count(text):
+    """Parses a comment count like `1,024` or `1.2K`, returning -1 if the
+    text isn't a count.
+    """
+    match = _COUNT_RE.fullmatch(text.strip().replace(',', ''))
+    if match is None or ('.' in match.group(1) and not match.group(2)):
+        return -1
+    return int(round(float(match.group(1))
+                     * _COUNT_SCALES[match.group(2).lower()]))
+
+
+def parse_comment_page(html, final_url, link=None, engine='html'):
+    """Parses the comment count from an article page, as the Selenium
+    scraper in data_gathering.ipynb did:
+    - the count is the text of the `comments-speech-bubble-top` element
+    (the second one if the page has two; pages with more have no count)
+    - counts can be abbreviated, i.e. `1.2K` is 1200
+    - pages without a count, or whose count isn't a number, get -1
+    comments, and are `archived` if the link
+    redirected to archive.nytimes.com, since archived pages don't show the
+    comments they once had
+
+    Doesn't fetch anything, so it can be tested and benchmarked on saved
+    pages.
+
+    Returns a dictionary with `link` (`link`, or `final_url` if None),
+    `comments` (int) and `archived` (0 or 1).
+
+    *** Arguments
+
+    html: string or bytes (decoded as UTF-8). Page source.
+
+    engine: string, default 'html'. 'html' parses the whole page with
+    Python's HTML parser; 'regex' only looks for the bubble element, which
+    is many times faster on large pages, but assumes the bubble doesn't
+    contain another element with the same tag.
+    """
+    if engine not in ['html', 'regex']:
+        raise ValueError("engine must be 'html' or 'regex'.")
+    bubbles = _bubble_texts(html or '', engine)
+
+    comments = -1
+    if len(bubbles) in [1, 2]:
+        comments = _parse_count(bubbles[-1])
+
+    archived = int(comments == -1 and 'archive.nytimes' in (final_url or ''))
+    return {'link': link if link is not None else final_url,
+            'comments': comments, 'archived': archived}
+
+
+def http_page_fetcher(max_retries=2, backoff=2.0, timeout=30, limiter=None):
+    """Returns a fetcher for `scrape_comment_counts` that downloads pages
+    with `requests`, one session per worker thread. Much lighter than a
+    browser, but only finds counts that are in the page's HTML rather than
+    added by JavaScript.
+    """
+    local = threading.local()
+
+    def fetch(url):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        resp = request_with_retry(local.session, 'GET', url, limiter=limiter,
+                                  max_retries=max_retries, backoff=backoff,
+                                  timeout=timeout)
+        resp.raise_for_status()
+        return resp.text, resp.url
+
+    return fetch
+
+
+def browser_page_fetcher(make_driver):
+    """Returns a fetcher for `scrape_comment_counts` that loads pages in a
+    browser, one per worker thread, for counts added by JavaScript.
+
+    make_driver: function with no arguments returning a Selenium WebDriver,
+    i.e. `lambda: webdriver.Chrome(options=headless_options)`. It's called
+    once in each worker, and can sign in to NYT before returning the driver.
+    Drivers are kept until the process exits; quit them with
+    `fetch.drivers` if needed.
+    """
+    local = threading.local()
+    drivers = []
+
+    def fetch(url):
+        if not hasattr(local, 'driver'):
+            local.driver = make_driver()
+            drivers.append(local.driver)
+        local.driver.get(url)
+        return local.driver.page_source, local.driver.current_url
+
+    fetch.drivers = drivers
+    return fetch
+
+
+# manifest of a page archive directory written by `save_page`
+PAGE_MANIFEST = 'pages.jsonl'
+
+
+def save_page(html, final_url, link, archive_dir):
+    """Saves a page's HTML to a gzipped file in `archive_dir`, named by a
+    hash of `link`, and returns its manifest record (`link`, `final_url`,
+    `file`). The caller appends the record to the directory's
+    `PAGE_MANIFEST`; see `scrape_comment_counts`.
+
+    Pages saved this way can be parsed again without refetching them, with
+    `page_archive.parse_saved_pages`.
+    """
+    file_name = hashlib.sha1(link.encode('utf-8')).hexdigest() + '.html.gz'
+    path = os.path.join(archive_dir, file_name)
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+    with gzip.open(path + '.tmp', 'wb') as f:
+        f.write(html)
+    os.replace(path + '.tmp', path)
+    return {'link': link, 'final_url': final_url, 'file': file_name}
+
+
+def load_comment_log(log_path):
+    """Reads the append-only log written by `scrape_comment_counts`.
+
+    Returns two dictionaries: link to result (`link`, `comments`,
+    `archived`) for every link scraped, and link to error message for links
+    whose most recent attempt failed.
+    """
+    done = {}
+    failed = {}
+    if not os.path.exists(log_path):
+        return done, failed
+
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # partial last line from an interrupted run
+                continue
+            if 'error' in record:
+                failed[record['link']] = record['error']
+            else:
+                done[record['link']] = record
+                failed.pop(record['link'], None)
+    return done, failed
+
+
+def scrape_comment_counts(links, log_path, fetcher=None, n_workers=4,
+                          retry_failed=True, archive_dir=None, engine='html',
+                          verbose=True):
+    """Scrapes the comment count of each article link, replacing the serial
+    Selenium loop in data_gathering.ipynb.
+
+    Links are deduplicated and split into `n_workers` shards, each scraped
+    in order by its own worker (and its own browser or HTTP session). Each
+    result is appended to the log at `log_path` as a JSON line as soon as
+    it's parsed, and links already in the log are skipped, so a crashed or
+    interrupted run is restarted by calling this again with the same
+    arguments. Failed fetches are logged with their error and retried on
+    the next run.
+
+    Pages are parsed with `parse_comment_page`.
+
+    Returns a list of result dictionaries (`link`, `comments`, `archived`),
+    like the `comments` list of the notebook, for every link in `links`
+    scraped so far, including in earlier runs.
+
+    *** Arguments
+
+    links: iterable of strings, i.e. `match_links1['link']`.
+
+    log_path: string. Path of the JSON lines log.
+
+    fetcher: function taking a URL and returning the page HTML and the
+    final URL after redirects. Default is `http_page_fetcher()`; use
+    `browser_page_fetcher` for pages needing JavaScript.
+
+    n_workers: int, default 4. Number of shards scraped concurrently.
+
+    retry_failed: Boolean, default True. Whether to retry links that failed
+    in an earlier run.
+
+    archive_dir: string (optional). Directory to also save each page's HTML
+    in with `save_page`, so counts can be parsed again later without
+    refetching. Created if it doesn't exist.
+
+    engine: string, default 'html'. See `parse_comment_page`.
+    """
+    if archive_dir is not None:
+        os.makedirs(archive_dir, exist_ok=True)
+    if fetcher is None:
+        fetcher = http_page_fetcher()
+    done, failed = load_comment_log(log_path)
+
+    to_scrape = []
+    seen = []
+    seen_set = set()
+    for link in links:
+        if not isinstance(link, str) or link in seen_set:
+            continue
+        seen.append(link)
+        seen_set.add(link)
+        if link in done or (link in failed and not retry_failed):
+            continue
+        to_scrape.append(link)
+
+    if verbose:
+        print(f"{len(seen)} unique links, {len(to_scrape)} to scrape")
+
+    lock = threading.Lock()
+    counter = {'count': 0}
+
+    def scrape_shard(shard, log):
+        for link in shard:
+            try:
+                html, final_url = fetcher(link)
+                record = parse_comment_page(html, final_url, link=link,
+                                            engine=engine)
+                page = None
+                if archive_dir is not None:
+                    page = save_page(html, final_url, link, archive_dir)
+            except Exception as e:
+                record = {'link': link, 'error': str(e)}
+                if verbose:
+                    print(f"Error scraping {link}: {e}")
+
+            with lock:
+                log.write(json.dumps(record) + '\n')
+                log.flush()
+                if 'error' not in record and page is not None:
+                    with open(os.path.join(archive_dir, PAGE_MANIFEST), 'a',
+                              encoding='utf-8') as manifest:
+                        manifest.write(json.dumps(page) + '\n')
+                if 'error' in record:
+                    failed[link] = record['error']
+                else:
+                    done[link] = record
+                counter['count'] += 1
+                if verbose and counter['count'] % 100 == 0:
+                    print(f"{counter['count']} links scraped")
+
+    n_workers = max(1, min(n_workers, len(to_scrape)))
+    with open(log_path, 'a', encoding='utf-8') as log, \
+            ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(scrape_shard, to_scrape[i::n_workers], log)
+                   for i in range(n_workers)]
+        for future in as_completed(futures):
+            future.result()
+
+    return [done[link] for link in seen if link in done]
@@ -0,0 +1,445 @@
+import re
+import numpy as np
+import pandas as pd
+
+# Ordered cascade of strategies used in data_gathering.ipynb to match
+# Facebook posts to NYT articles. Each post is matched by the first strategy
+# that finds at least one article.
+#
+# `matched_on`: label recorded for posts matched by the strategy.
+# `post_cols` / `article_cols`: key columns that must all be equal.
+# `exclude_col` (optional): posts with this column populated are skipped by
+# the strategy, i.e. posts flagged as duplicates on that key.
+DEFAULT_STRATEGIES = [
+    {'matched_on': 'link', 'post_cols': ['trim_link'],
+     'article_cols': ['web_url'], 'exclude_col': 'dupes_on_link'},
+    {'matched_on': 'desc', 'post_cols': ['description'],
+     'article_cols': ['snippet'], 'exclude_col': 'dupes_on_desc'},
+    {'matched_on': 'name', 'post_cols': ['name'],
+     'article_cols': ['main_headline'], 'exclude_col': 'dupes_on_name'},
+    {'matched_on': 'name', 'post_cols': ['name', 'link_date'],
+     'article_cols': ['main_headline', 'link_date']},
+    {'matched_on': 'desc', 'post_cols': ['description', 'link_date'],
+     'article_cols': ['snippet', 'link_date']},
+    {'matched_on': 'link', 'post_cols': ['trim_link'],
+     'article_cols': ['web_url']},
+    {'matched_on': 'name', 'post_cols': ['name', 'post_date'],
+     'article_cols': ['main_headline', 'pub_dateonly']},
+    {'matched_on': 'desc', 'post_cols': ['description', 'post_date'],
+     'article_cols': ['snippet', 'pub_dateonly']},
+]
+
+
+def _normalize_key(value):
+    """Lowercases and collapses whitespace in string keys."""
+    if isinstance(value, str):
+        return ' '.join(value.lower().split())
+    return value
+
+
+def _is_valid_key(value):
+    """Missing values and empty strings never match anything."""
+    if value is None or value == '':
+        return False
+    return not (isinstance(value, float) and np.isnan(value))
+
+
+def _key_values(df, cols, normalize=False):
+    """Returns a list with the key for each row of `df`: the value of `cols`
+    for a single column, or a tuple of values for several columns. Rows with
+    a missing or empty value in any key column get None.
+    """
+    arrays = []
+    for col in cols:
+        values = df[col].values
+        if normalize:
+            values = [_normalize_key(value) for value in values]
+        arrays.append(values)
+
+    keys = []
+    for row in zip(*arrays):
+        if all(_is_valid_key(value) for value in row):
+            keys.append(row if len(row) > 1 else row[0])
+        else:
+            keys.append(None)
+    return keys
+
+
+def _build_index(df, cols, normalize=False):
+    """Hashes the key columns of `df` once, returning a dictionary of key to
+    the list of row positions with that key.
+    """
+    index = {}
+    for pos, key in enumerate(_key_values(df, cols, normalize)):
+        if key is not None:
+            index.setdefault(key, []).append(pos)
+    return index
+
+
+def _match_positions(df, df_nyt, strategies, normalize):
+    """Runs the cascade and returns lists of post row positions, article row
+    positions, strategy numbers and candidate counts, one entry per matched
+    (post, article) pair.
+    """
+    usable = []
+    for num, strategy in enumerate(strategies):
+        missing = [col for col in strategy['post_cols'] if col not in df] + \
+                  [col for col in strategy['article_cols'] if col not in df_nyt]
+        if len(missing) > 0:
+            print(f"Skipping strategy {num} ({strategy['matched_on']}), "
+                  f"missing columns: {missing}")
+        else:
+            usable.append(num)
+
+    # build each article index once, sharing it between strategies that
+    # use the same article keys
+    indexes = {}
+    for num in usable:
+        cols = tuple(strategies[num]['article_cols'])
+        if cols not in indexes:
+            indexes[cols] = _build_index(df_nyt, cols, normalize)
+
+    cascade = []
+    for num in usable:
+        strategy = strategies[num]
+        exclude_col = strategy.get('exclude_col')
+        if exclude_col is not None and exclude_col in df:
+            excluded = df[exclude_col].notna().values
+        else:
+            excluded = None
+        cascade.append((num, _key_values(df, strategy['post_cols'], normalize),
+                        excluded, indexes[tuple(strategy['article_cols'])]))
+
+    post_pos, article_pos, strategy_nums, n_candidates = [], [], [], []
+
+    # single pass over posts, stopping at the first strategy with a match
+    for pos in range(len(df)):
+        for num, keys, excluded, index in cascade:
+            if excluded is not None and excluded[pos]:
+                continue
+            key = keys[pos]
+            if key is None:
+                continue
+            candidates = index.get(key)
+            if candidates:
+                post_pos.extend([pos] * len(candidates))
+                article_pos.extend(candidates)
+                strategy_nums.extend([num] * len(candidates))
+                n_candidates.extend([len(candidates)] * len(candidates))
+                break
+
+    return post_pos, article_pos, strategy_nums, n_candidates
+
+
+def match_posts(df, df_nyt, strategies=None, normalize=False, post_id_col='id',
+                article_id_col='_id'):
+    """Matches Facebook posts to NYT articles using an ordered cascade of
+    exact key matches, hashing the article keys once per strategy and
+    resolving each post in a single pass.
+
+    Returns a dataframe with one row per matched (post, article) pair:
+
+    - `id` and `_id` (or `post_id_col` and `article_id_col`): the post and
+    article IDs
+    - `matched_on`: label of the strategy that matched the post
+    - `strategy`: position of that strategy in `strategies`
+    - `n_candidates`: number of articles the post matched. Over 1 means the
+    match is ambiguous (1:N)
+    - `article_n_posts`: number of posts matched to the same article. Over 1
+    means several posts share the article (N:1)
+
+    Posts that matched nothing are not included. To mark matched posts the
+    way the notebook does, use
+    `df['matched_on'] = df['id'].map(pairs.groupby('id')['matched_on'].first())`.
+
+    *** Arguments
+
+    df: Dataframe of Facebook posts.
+
+    df_nyt: Dataframe of NYT articles.
+
+    strategies: list of dicts (optional). Cascade to run, see
+    `DEFAULT_STRATEGIES` for the format. Strategies whose columns are
+    missing from either dataframe are skipped with a message.
+
+    normalize: Boolean, default False. Whether to lowercase and collapse
+    whitespace in string keys before matching.
+    """
+    if strategies is None:
+        strategies = DEFAULT_STRATEGIES
+
+    post_pos, article_pos, strategy_nums, n_candidates = \
+        _match_positions(df, df_nyt, strategies, normalize)
+
+    pairs = pd.DataFrame({
+        post_id_col: df[post_id_col].values[post_pos],
+        article_id_col: df_nyt[article_id_col].values[article_pos],
+        'matched_on': [strategies[num]['matched_on'] for num in strategy_nums],
+        'strategy': np.array(strategy_nums, dtype=int),
+        'n_candidates': np.array(n_candidates, dtype=int)})
+
+    pairs['article_n_posts'] = pairs.groupby(article_id_col)[post_id_col]\
+                                    .transform('nunique')
+    return pairs
+
+
+def build_matches(df, df_nyt, strategies=None, normalize=False,
+                  post_id_col='id', article_id_col='_id'):
+    """Builds the full `df_matches` table in one call: runs the `match_posts`
+    cascade and returns one row per matched (post, article) pair with every
+    post column, every article column, and the `matched_on`, `strategy`,
+    `n_candidates` and `article_n_posts` columns from `match_posts`.
+
+    Article columns with the same name as a post column get a `_nyt` suffix.
+    """
+    if strategies is None:
+        strategies = DEFAULT_STRATEGIES
+
+    post_pos, article_pos, strategy_nums, n_candidates = \
+        _match_positions(df, df_nyt, strategies, normalize)
+
+    posts = df.iloc[post_pos].reset_index(drop=True)
+    articles = df_nyt.iloc[article_pos].reset_index(drop=True)
+    articles.columns = [f"{col}_nyt" if col in posts.columns else col
+                        for col in articles.columns]
+
+    df_matches = pd.concat([posts, articles], axis=1)
+    df_matches['matched_on'] = [strategies[num]['matched_on']
+                                for num in strategy_nums]
+    df_matches['strategy'] = np.array(strategy_nums, dtype=int)
+    df_matches['n_candidates'] = np.array(n_candidates, dtype=int)
+
+    article_id = df_nyt[article_id_col].values[article_pos]
+    df_matches['article_n_posts'] = df_matches[post_id_col]\
+        .groupby(article_id).transform('nunique')
+    return df_matches
+
+
+# Shingle hashes are reduced modulo this Mersenne prime to fit in 31 bits
+_MINHASH_PRIME = (1 << 31) - 1
+# Empty signature value, larger than any multiply-shift hash
+_MINHASH_EMPTY = np.uint64(1 << 32)
+
+
+def _shingle_hashes(text, shingle_size):
+    """Returns the unique hashes of the character shingles in `text`, after
+    lowercasing and replacing punctuation with spaces. Shingles are hashed
+    with a polynomial rolling hash over the text's bytes, so the whole
+    document is hashed in a few numpy operations.
+    """
+    if not isinstance(text, str):
+        return np.array([], dtype=np.uint64)
+    text = ' '.join(re.sub(r"[^a-z0-9 ]", ' ', text.lower()).split())
+
+    chars = np.frombuffer(text.encode('ascii'), dtype=np.uint8)\
+              .astype(np.uint64)
+    n = max(len(chars) - shingle_size + 1, 1) if len(chars) else 0
+    hashes = np.zeros(n, dtype=np.uint64)
+    for j in range(min(shingle_size, len(chars))):
+        hashes = hashes * np.uint64(257) + chars[j:j + n]
+
+    return np.unique(hashes % np.uint64(_MINHASH_PRIME))
+
+
+def _to_days(dates):
+    """Converts a Series of dates or date strings to float days since the
+    epoch, with NaN where the date is missing or can't be parsed.
+    """
+    dates = pd.to_datetime(dates, utc=True, errors='coerce')
+    days = dates.values.astype('datetime64[D]').astype(np.int64)\
+                .astype(float)
+    days[dates.isna().values] = np.nan
+    return days
+
+
+class ArticleLSHIndex():
+    """Locality-sensitive hashing index for finding near-duplicate articles,
+    for posts that couldn't be matched on exact keys with `match_posts`.
+
+    Each article's text columns are joined and split into character
+    shingles, which are summarized with a MinHash signature of `num_perm`
+    values. Signatures are split into `bands` bands, and articles sharing
+    any band with a post become its candidates, so only a small fraction of
+    the archive is compared against each post. Candidates are scored by
+    their Jaccard similarity to the post, estimated from the signatures.
+
+    The similarity at which a pair has a 50% chance of becoming a candidate
+    is roughly `(1 / bands) ** (bands / num_perm)`; 0.5 for the defaults.
+
+    *** Example
+
+    lsh = matcher.ArticleLSHIndex().fit(df_nyt)
+    df_fuzzy = lsh.match(df.loc[df['matched_on'].isna()])
+    """
+
+    def __init__(self, num_perm=64, bands=16, shingle_size=5, seed=42):
+        if num_perm % bands != 0:
+            raise ValueError("`num_perm` should be a multiple of `bands`.")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        # multiply-shift hash family: ((a * x + b) mod 2^64) >> 32 with odd
+        # random 64-bit a, which avoids a modulo per shingle and permutation
+        rng = np.random.RandomState(seed)
+        self._a = self._random_uint64(rng, num_perm) | np.uint64(1)
+        self._b = self._random_uint64(rng, num_perm)
+        self._band_weights = rng.randint(1, _MINHASH_PRIME, size=self.rows)\
+                                .astype(np.uint64)
+
+    @staticmethod
+    def _random_uint64(rng, size):
+        high = rng.randint(0, 1 << 32, size=size, dtype=np.int64)\
+                  .astype(np.uint64)
+        low = rng.randint(0, 1 << 32, size=size, dtype=np.int64)\
+                  .astype(np.uint64)
+        return (high << np.uint64(32)) | low
+
+    def _signatures(self, texts, chunk_size=2000, max_values=2 ** 22):
+        """Returns a (len(texts), num_perm) array of MinHash signatures, and
+        a mask of which texts had any shingles. Texts are processed in
+        chunks, with the permutations applied to every shingle in the chunk
+        at once, a slice of permutations at a time so that no more than
+        `max_values` hashed values are held at once.
+        """
+        sigs = np.full((len(texts), self.num_perm), _MINHASH_EMPTY,
+                       dtype=np.uint64)
+        valid = np.zeros(len(texts), dtype=bool)
+
+        for start in range(0, len(texts), chunk_size):
+            hashes = [_shingle_hashes(text, self.shingle_size)
+                      for text in texts[start:start + chunk_size]]
+            lengths = np.array([len(h) for h in hashes])
+            has_shingles = lengths > 0
+            if not has_shingles.any():
+                continue
+
+            # offsets of each text's first shingle, for reduceat
+            offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            shingles = np.concatenate(hashes)
+            rows = start + np.flatnonzero(has_shingles)
+            step = max(1, max_values // len(shingles))
+            for first in range(0, self.num_perm, step):
+                a = self._a[first:first + step]
+                b = self._b[first:first + step]
+                perms = (np.outer(a, shingles) + b[:, None]) >> np.uint64(32)
+                mins = np.minimum.reduceat(perms, offsets[has_shingles],
+                                           axis=1)
+                sigs[rows, first:first + step] = mins.T
+            valid[rows] = True
+
+        return sigs, valid
+
+    def _band_hashes(self, sigs):
+        """Combines each band of the signatures into a single uint64 hash,
+        returning a (len(sigs), bands) array. Overflow just wraps around.
+        """
+        banded = sigs.reshape(len(sigs), self.bands, self.rows)
+        return (banded * self._band_weights).sum(axis=2)
+
+    @staticmethod
+    def _join_text(df, text_cols):
+        return [' '.join(value for value in row if isinstance(value, str))
+                for row in zip(*[df[col].values for col in text_cols])]
+
+    def fit(self, df_nyt, text_cols=['main_headline', 'snippet',
+                                     'lead_paragraph'],
+            date_col='pub_date', id_col='_id'):
+        """Builds the index over the articles in `df_nyt`. Returns the index
+        itself, so it can be chained with `match`.
+
+        `date_col` (optional) holds each article's publication date, used
+        for the date window when matching.
+        """
+        self.id_col = id_col
+        self.article_ids = df_nyt[id_col].values
+        self._sigs, self._valid = self._signatures(
+            self._join_text(df_nyt, text_cols))
+
+        if date_col is not None:
+            self._days = _to_days(df_nyt[date_col])
+        else:
+            self._days = np.full(len(df_nyt), np.nan)
+
+        # one sorted array of band hashes per band; candidates for a query
+        # are found with a binary search instead of a dict per band
+        band_hashes = self._band_hashes(self._sigs)
+        band_hashes[~self._valid] = 0
+        self._band_order = np.argsort(band_hashes, axis=0, kind='stable')
+        self._band_sorted = np.take_along_axis(band_hashes, self._band_order,
+                                               axis=0)
+        return self
+
+    def _candidates(self, band_hashes):
+        """Returns the positions of articles sharing at least one band."""
+        found = []
+        for band in range(self.bands):
+            col = self._band_sorted[:, band]
+            lo = np.searchsorted(col, band_hashes[band], side='left')
+            hi = np.searchsorted(col, band_hashes[band], side='right')
+            if hi > lo:
+                found.append(self._band_order[lo:hi, band])
+        if not found:
+            return np.array([], dtype=int)
+        cands = np.unique(np.concatenate(found))
+        return cands[self._valid[cands]]
+
+    def match(self, df, text_cols=['name', 'description'], date_col='posted_at',
+              id_col='id', window_days=3, min_jaccard=0.5, top_n=1):
+        """Finds the most similar articles for each post in `df`.
+
+        Returns a dataframe with one row per (post, candidate article) with
+        `id` and `_id` (named after `id_col` and the `id_col` passed to
+        `fit`, with `_article` added to the latter if they're the same), the
+        estimated `jaccard` similarity, and the candidate's `rank` for that
+        post (1 is best). Posts without any candidate at or above
+        `min_jaccard` are not included.
+
+        *** Arguments
+
+        df: Dataframe of posts to match, i.e. posts where `matched_on` is
+        null.
+
+        text_cols: list of post columns to join and compare with the
+        article text.
+
+        date_col: string (optional). Post date column. Candidates published
+        more than `window_days` days before or after the post are dropped.
+        Use None to skip the date filter. Missing dates are never filtered.
+
+        top_n: int, default 1. Number of candidates to keep per post.
+        """
+        sigs, valid = self._signatures(self._join_text(df, text_cols))
+        band_hashes = self._band_hashes(sigs)
+
+        if date_col is not None:
+            post_days = _to_days(df[date_col])
+        else:
+            post_days = np.full(len(df), np.nan)
+
+        post_ids = df[id_col].values
+        rows = []
+        for pos in np.flatnonzero(valid):
+            cands = self._candidates(band_hashes[pos])
+
+            if len(cands) > 0 and not np.isnan(post_days[pos]):
+                diff = np.abs(self._days[cands] - post_days[pos])
+                cands = cands[~(diff > window_days)]
+            if len(cands) == 0:
+                continue
+
+            jaccard = (self._sigs[cands] == sigs[pos]).mean(axis=1)
+            keep = jaccard >= min_jaccard
+            cands, jaccard = cands[keep], jaccard[keep]
+
+            order = np.argsort(-jaccard, kind='stable')[:top_n]
+            for rank, i in enumerate(order, start=1):
+                rows.append([post_ids[pos], self.article_ids[cands[i]],
+                             jaccard[i], rank])
+
+        article_col = self.id_col
+        if article_col == id_col:
+            article_col = f"{article_col}_article"
+        return pd.DataFrame(rows, columns=[id_col, article_col, 'jaccard',
+                                           'rank'])
@@ -1,17 +1,236 @@
 import pandas as pd
 import numpy as np
+from functools import lru_cache
 from sklearn import metrics
 import matplotlib.pyplot as plt
 import seaborn as sns
 import joblib
+from scipy import sparse
+import scipy.stats as st
 from sklearn import metrics
 from sklearn.model_selection import GridSearchCV, cross_val_score
+from sklearn.model_selection import RandomizedSearchCV
+# enables the halving searches, which are still experimental in sklearn
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingGridSearchCV, HalvingRandomSearchCV
 from sklearn.pipeline import Pipeline
+from sklearn.base import clone
 import joblib
 
-def eval_clf_model(clf, X_test, y_test, X_train, y_train, score='std',
+def _clf_scores(clf, X):
+    """Returns `predict_proba` (or `decision_function`) output for `X`, or
+    None if the classifier has neither. For binary targets only the scores
+    for the second class are returned.
+    """
+    if hasattr(clf, 'predict_proba'):
+        try:
+            scores = clf.predict_proba(X)
+        except AttributeError:
+            # i.e. SGDClassifier with hinge loss
+            scores = None
+        else:
+            return scores[:, 1] if scores.shape[1] == 2 else scores
+    if hasattr(clf, 'decision_function'):
+        return clf.decision_function(X)
+    return None
+
+
+def metrics_from_cm(cm):
+    """Calculates classification metrics from a confusion matrix (rows are
+    true classes, columns predicted), so predictions don't have to be
+    scanned again for each metric.
+
+    Returns a dictionary with per class arrays of `precision`, `recall`,
+    `f1` and `support`, plus `accuracy`, `macro_precision`, `macro_recall`,
+    `macro_f1`, `balanced_accuracy` and the support weighted averages.
+    Metrics that divide by zero are 0, as in sklearn, except
+    `balanced_accuracy`, which is NaN if no class has any support. Macro
+    averages only cover classes that are true or predicted at least once,
+    as in `metrics.classification_report`.
+    """
+    cm = np.asarray(cm, dtype=np.float64)
+    tp = np.diag(cm)
+    support = cm.sum(axis=1)
+    predicted = cm.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted > 0, tp / predicted, 0.0)
+        recall = np.where(support > 0, tp / support, 0.0)
+        f1 = np.where(precision + recall > 0,
+                      2 * precision * recall / (precision + recall), 0.0)
+
+    total = cm.sum()
+    weights = support / total if total > 0 else support
+    has_support = support > 0
+    present = has_support | (predicted > 0)
+    if not present.any():
+        present = np.ones(len(cm), dtype=bool)
+    return {'precision': precision, 'recall': recall, 'f1': f1,
+            'support': support.astype(np.int64),
+            'accuracy': tp.sum() / total if total > 0 else 0.0,
+            'macro_precision': precision[present].mean(),
+            'macro_recall': recall[present].mean(),
+            'macro_f1': f1[present].mean(),
+            'balanced_accuracy': (recall[has_support].mean()
+                                  if has_support.any() else np.nan),
+            'weighted_precision': (precision * weights).sum(),
+            'weighted_recall': (recall * weights).sum(),
+            'weighted_f1': (f1 * weights).sum()}
+
+
+def _format_report(results, digits=2):
+    """Formats the metrics in `results` from `evaluate_clf_model` like
+    `metrics.classification_report`.
+    """
+    mets = results['metrics']
+    names = [str(c) for c in results['classes']]
+    width = max(len(name) for name in names + ['weighted avg'])
+    headers = ['precision', 'recall', 'f1-score', 'support']
+
+    lines = [' ' * (width + 1) + ''.join(f"{h:>10}" for h in headers), '']
+    for i, name in enumerate(names):
+        values = [mets['precision'][i], mets['recall'][i], mets['f1'][i]]
+        lines.append(f"{name:>{width}} "
+                     + ''.join(f"{v:>10.{digits}f}" for v in values)
+                     + f"{mets['support'][i]:>10}")
+    lines.append('')
+
+    total = mets['support'].sum()
+    lines.append(f"{'accuracy':>{width}} " + ' ' * 20
+                 + f"{mets['accuracy']:>10.{digits}f}{total:>10}")
+    for avg, prefix in [('macro avg', 'macro'), ('weighted avg', 'weighted')]:
+        values = [mets[f"{prefix}_{m}"] for m in ['precision', 'recall', 'f1']]
+        lines.append(f"{avg:>{width}} "
+                     + ''.join(f"{v:>10.{digits}f}" for v in values)
+                     + f"{total:>10}")
+    return '\n'.join(lines) + '\n'
+
+
+def evaluate_clf_model(clf, X_test, y_test, X_train=None, y_train=None):
+    """Evaluates a fit classifier without printing or plotting anything, for
+    evaluating many models in batch.
+
+    Predictions and probabilities are calculated once per dataset, and every
+    metric is derived from one confusion matrix.
+
+    Returns a dictionary with a `test` entry (and `train`, if training data
+    is provided), each a dictionary of:
+    - `classes`: class values, in confusion matrix order
+    - `y_true`: true values, as an array
+    - `preds`: predictions
+    - `scores`: `predict_proba` for the second class if binary, all classes
+    if multi-class (or `decision_function` output if there's no
+    `predict_proba`); None if neither is available
+    - `cm`: confusion matrix of counts
+    - `metrics`: see `metrics_from_cm`, plus `roc_auc` and
+    `average_precision` from the scores if binary
+
+    Use `metrics_table` to compare results as a dataframe.
+    """
+    data = {'test': (X_test, y_test)}
+    if X_train is not None and y_train is not None:
+        data['train'] = (X_train, y_train)
+
+    results = {}
+    for name, (X, y) in data.items():
+        y = np.asarray(y)
+        preds = clf.predict(X)
+        scores = _clf_scores(clf, X)
+
+        classes = getattr(clf, 'classes_', None)
+        if classes is None:
+            classes = np.unique(np.concatenate([y, preds]))
+        cm = metrics.confusion_matrix(y, preds, labels=classes)
+
+        mets = metrics_from_cm(cm)
+        if len(classes) == 2 and scores is not None and scores.ndim == 1:
+            y_pos = y == classes[1]
+            mets['roc_auc'] = metrics.roc_auc_score(y_pos, scores)
+            mets['average_precision'] = \
+                metrics.average_precision_score(y_pos, scores)
+
+        results[name] = {'classes': np.asarray(classes), 'y_true': y,
+                         'preds': preds, 'scores': scores, 'cm': cm,
+                         'metrics': mets}
+    return results
+
+
+def metrics_table(results, labels=None):
+    """Turns the `results` from `evaluate_clf_model` into a dataframe with
+    one row per dataset (i.e. train and test) and one column per metric, with
+    per class metrics named like `f1_High`. `labels` replaces the class
+    values in column names.
+
+    Pass a dictionary of model name to results to get one row per model and
+    dataset instead.
+    """
+    if 'test' in results and 'metrics' in results['test']:
+        results = {None: results}
+
+    rows = []
+    for model, model_results in results.items():
+        for dataset, res in model_results.items():
+            names = labels if labels is not None else res['classes']
+            row = {'model': model, 'dataset': dataset}
+            for key, value in res['metrics'].items():
+                if np.ndim(value) == 0:
+                    row[key] = value
+                else:
+                    row.update({f"{key}_{name}": v
+                                for name, v in zip(names, value)})
+            rows.append(row)
+
+    df = pd.DataFrame(rows)
+    if df['model'].isna().all():
+        df = df.drop(columns='model')
+    return df
+
+
+def plot_clf_results(results, labels, normalize_cm='true'):
+    """Plots the confusion matrix for test data from `evaluate_clf_model`
+    results, plus ROC and precision-recall curves if binary, without
+    rerunning the model.
+
+    normalize_cm: string, default `true`. Setting for whether and how to
+    normalize the confusion matrix. See sklearn documentation for options.
+    """
+    res = results['test']
+    cm = res['cm'].astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if normalize_cm == 'true':
+            cm = cm / cm.sum(axis=1, keepdims=True)
+        elif normalize_cm == 'pred':
+            cm = cm / cm.sum(axis=0, keepdims=True)
+        elif normalize_cm == 'all':
+            cm = cm / cm.sum()
+    cm = np.nan_to_num(cm)
+
+    binary = len(res['classes']) == 2 and 'roc_auc' in res['metrics']
+    if binary:
+        fig, [ax1, ax2, ax3] = plt.subplots(figsize=[10, 3], nrows=1, ncols=3)
+    else:
+        fig, ax1 = plt.subplots(figsize=[6, 4])
+    plt.tight_layout(pad=2.5)
+
+    metrics.ConfusionMatrixDisplay(cm, display_labels=labels).plot(
+        cmap='Reds', ax=ax1)
+
+    if binary:
+        y_pos = res['y_true'] == res['classes'][1]
+        auc = np.round(res['metrics']['roc_auc'], 2)
+        metrics.RocCurveDisplay.from_predictions(y_pos, res['scores'], ax=ax2)
+        ax2.legend(loc='best', fontsize='small', labels=[f'AUC: {auc}'])
+
+        ap = np.round(res['metrics']['average_precision'], 2)
+        metrics.PrecisionRecallDisplay.from_predictions(y_pos, res['scores'],
+                                                        ax=ax3)
+        ax3.legend(loc='best', fontsize='small', labels=[f'AP: {ap}'])
+    plt.show();
+
+
+def eval_clf_model(clf, X_test, y_test, X_train=None, y_train=None, score='std',
                reports=True, labels=['Class 0', 'Class 1'], 
-               normalize_cm='true'):
+               normalize_cm='true', plots=True, return_results=False):
     """Shows metrics and plots visualizations to interpret classifier model 
     performance.
     
@@ -44,117 +263,151 @@ def eval_clf_model(clf, X_test, y_test, X_train, y_train, score='std',
     
     normalize_cm: string, default `true`. Setting for whether and how to
     normalize the confusion matrix. See sklearn documentation for options.
+
+    plots: boolean (optional). Default is True. Set to False to skip the
+    graphs.
+
+    return_results: boolean (optional). Default is False. Set to True to
+    return the predictions, confusion matrices and metrics from
+    `evaluate_clf_model`. To evaluate models without printing anything, call
+    `evaluate_clf_model` directly.
     """
-    multi = True if len(labels) > 2 else False
-    
     spacer = '*'*30
     
-    # Get predictions 1 time only, since they will be used in a few spots
-    test_preds = clf.predict(X_test)
-    train_preds = clf.predict(X_train)
-    
-    #if multi:
-    #    test_predict_proba = clf.predict_proba(X_test)
+    # Get predictions and probabilities 1 time only, and derive every metric
+    # and plot from them
+    results = evaluate_clf_model(clf, X_test, y_test, X_train, y_train)
+    has_train = 'train' in results
+    test_m = results['test']['metrics']
     
     # print classification reports
     if reports:
-        print(spacer + ' Training Data ' + spacer)
-        print(metrics.classification_report(y_train, train_preds))
-        print()
+        if has_train:
+            print(spacer + ' Training Data ' + spacer)
+            print(_format_report(results['train']))
+            print()
         print(spacer + ' Test Data ' + spacer)
-        print(metrics.classification_report(y_test, test_preds))
+        print(_format_report(results['test']))
         print()
     
     # print scores from train and test next to each other for easy comparison
-    print(spacer + ' Training Scores ' + spacer)
+    if has_train:
+        train_m = results['train']['metrics']
+        print(spacer + ' Training Scores ' + spacer)
 
-    # Train
-    if score == 'std':
-        train_f1 = np.round(metrics.f1_score(y_train, train_preds, average=None), 4)
-        print(f"                  Training F1 = {train_f1}")
-        train_r = np.round(metrics.recall_score(y_train, train_preds, average=None), 4)
-        print(f"              Training Recall = {train_r}")
-        train_acc = np.round(metrics.accuracy_score(y_train, train_preds), 4)
-        print(f"            Training Accuracy = {train_acc}")
-    elif score == 'macro':
-        train_f1m = np.round(metrics.f1_score(y_train, train_preds, average='macro'), 4)
-        print(f"            Training Macro F1 = {train_f1m}")
-        train_rm = np.round(metrics.recall_score(y_train, train_preds, average='macro'), 4)
-        print(f"        Training Macro Recall = {train_rm}")
-        train_accbal = np.round(metrics.balanced_accuracy_score(y_train, train_preds), 4)
-        print(f"   Training Balanced Accuracy = {train_accbal}")
-    print()
+        # Train
+        if score == 'std':
+            train_f1 = np.round(train_m['f1'], 4)
+            print(f"                  Training F1 = {train_f1}")
+            train_r = np.round(train_m['recall'], 4)
+            print(f"              Training Recall = {train_r}")
+            train_acc = np.round(train_m['accuracy'], 4)
+            print(f"            Training Accuracy = {train_acc}")
+        elif score == 'macro':
+            train_f1m = np.round(train_m['macro_f1'], 4)
+            print(f"            Training Macro F1 = {train_f1m}")
+            train_rm = np.round(train_m['macro_recall'], 4)
+            print(f"        Training Macro Recall = {train_rm}")
+            train_accbal = np.round(train_m['balanced_accuracy'], 4)
+            print(f"   Training Balanced Accuracy = {train_accbal}")
+        print()
     print(spacer + ' Test Scores ' + spacer)
     
     #Test
     if score == 'std':
-        test_f1 = np.round(metrics.f1_score(y_test, test_preds, average=None), 4)
+        test_f1 = np.round(test_m['f1'], 4)
         print(f"                      Test F1 = {test_f1}")
-        test_r = np.round(metrics.recall_score(y_test, test_preds, average=None), 4)
+        test_r = np.round(test_m['recall'], 4)
         print(f"                  Test Recall = {test_r}")
-        test_acc = np.round(metrics.accuracy_score(y_test, test_preds), 4)
+        test_acc = np.round(test_m['accuracy'], 4)
         print(f"                Test Accuracy = {test_acc}")
         
     elif score == 'macro':
-        test_f1m = np.round(metrics.f1_score(y_test, test_preds, average='macro'), 4)
+        test_f1m = np.round(test_m['macro_f1'], 4)
         print(f"                Test Macro F1 = {test_f1m}")
-        test_rm = np.round(metrics.recall_score(y_test, test_preds, average='macro'), 4)
+        test_rm = np.round(test_m['macro_recall'], 4)
         print(f"            Test Macro Recall = {test_rm}")
-        test_accbal = np.round(metrics.balanced_accuracy_score(y_test, test_preds), 4)
+        test_accbal = np.round(test_m['balanced_accuracy'], 4)
         print(f"       Test Balanced Accuracy = {test_accbal}")
     print()
-    print(spacer + ' Differences ' + spacer)
     
     #Diffs
-    if score == 'std':
-        print(f"               Train-Test F1 Diff = {test_f1 - train_f1}")       
-        print(f"           Train-Test Recall Diff = {test_r - train_r}")       
-        print(f"         Train-Test Accuracy Diff = {test_acc - train_acc}")     
-    elif score == 'macro':  
-        print(f"         Train-Test Macro F1 Diff = {test_f1m - train_f1m}")      
-        print(f"     Train-Test Macro Recall Diff = {test_rm - train_rm}")       
-        print(f"Train-Test Balanced Accuracy Diff = {test_accbal - train_accbal}")
-    
-    print()
-    print(spacer + ' Graphs for Test ' + spacer)
+    if has_train:
+        print(spacer + ' Differences ' + spacer)
+        if score == 'std':
+            print(f"               Train-Test F1 Diff = {test_f1 - train_f1}")       
+            print(f"           Train-Test Recall Diff = {test_r - train_r}")       
+            print(f"         Train-Test Accuracy Diff = {test_acc - train_acc}")     
+        elif score == 'macro':  
+            print(f"         Train-Test Macro F1 Diff = {test_f1m - train_f1m}")      
+            print(f"     Train-Test Macro Recall Diff = {test_rm - train_rm}")       
+            print(f"Train-Test Balanced Accuracy Diff = {test_accbal - train_accbal}")
+        print()
     
-    # plot graphs
+    # plot graphs from the predictions above, without rerunning the model
+    if plots:
+        print(spacer + ' Graphs for Test ' + spacer)
+        plot_clf_results(results, labels, normalize_cm=normalize_cm)
     
-    if not multi:
-        auc = np.round(metrics.roc_auc_score(y_test, test_preds), 2)
-        
-        ap = np.round(metrics.average_precision_score(y_test, test_preds), 2)
+    if return_results:
+        return results
+    return None
 
-        fig, [ax1, ax2, ax3] = plt.subplots(figsize=[10, 3], nrows=1, ncols=3)
-        plt.tight_layout(pad=2.5)
-        metrics.plot_confusion_matrix(clf, X_test, y_test, 
-                normalize=normalize_cm, display_labels=labels, 
-                                      cmap='Reds', ax=ax1)
-        metrics.plot_roc_curve(clf, X_test, y_test, ax=ax2)
-        ax2.legend(loc='best', fontsize='small', labels=[f'AUC: {auc}'])
 
-        metrics.plot_precision_recall_curve(clf, X_test, y_test, ax=ax3)
-        ax3.legend(loc='best', fontsize='small')
-        ax3.legend(loc='best', fontsize='small', labels=[f'AP: {ap}'])
-        plt.show();
-    
-    #if multi-class, just plot confusion matrix
+def candidate_fit_times(gs):
+    """Returns a dataframe of each candidate's mean CV score, mean fit and
+    score times in seconds, and params (one `param_` column each) from a fit
+    search object, sorted by rank. Halving searches have one row per
+    candidate per round, with the round (`iter`) and number of training
+    samples used (`n_resources`), last round first.
+    """
+    results = pd.DataFrame(gs.cv_results_)
+
+    cols = ['rank_test_score', 'mean_test_score', 'mean_fit_time',
+            'std_fit_time', 'mean_score_time']
+    cols += [col for col in ['iter', 'n_resources'] if col in results]
+    cols += [col for col in results.columns if col.startswith('param_')]
+    if 'iter' in results:
+        # last round first, since scores from different rounds use different
+        # amounts of data
+        results = results.sort_values(['iter', 'rank_test_score'],
+                                      ascending=[False, True])
     else:
-        fig, ax1 = plt.subplots(figsize=[6, 4])
-        plt.tight_layout(pad=2.5)
-        metrics.plot_confusion_matrix(clf, X_test, y_test, 
-                normalize=normalize_cm, display_labels=labels, cmap='Reds', 
-                                        ax=ax1)
-        plt.show();
-        
-    
-    return None
+        results = results.sort_values('rank_test_score')
+    return results[cols].reset_index(drop=True)
+
+
+def _make_search(search, clf_pipe, grid_params, scoring, n_jobs, verbose, cv,
+                 n_iter, factor, random_state):
+    """Creates the sklearn search object for `clf_gridsearch_wpipe`."""
+    if search == 'grid':
+        return GridSearchCV(clf_pipe, grid_params, n_jobs=n_jobs,
+                            verbose=verbose, scoring=scoring, cv=cv)
+    elif search == 'random':
+        return RandomizedSearchCV(clf_pipe, grid_params, n_iter=n_iter,
+                                  n_jobs=n_jobs, verbose=verbose,
+                                  scoring=scoring, cv=cv,
+                                  random_state=random_state)
+    elif search == 'halving':
+        return HalvingGridSearchCV(clf_pipe, grid_params, factor=factor,
+                                   n_jobs=n_jobs, verbose=verbose,
+                                   scoring=scoring, cv=cv,
+                                   random_state=random_state)
+    elif search == 'halving_random':
+        return HalvingRandomSearchCV(clf_pipe, grid_params, factor=factor,
+                                     n_jobs=n_jobs, verbose=verbose,
+                                     scoring=scoring, cv=cv,
+                                     random_state=random_state)
+    else:
+        return None
 
 
 def clf_gridsearch_wpipe(clf_pipe, grid_params, X_train, y_train, X_test, y_test,
                      class_labels, file_name, save_path, 
                      scoring='recall', score_type='std', n_jobs=-1, verbose=1,
-                     normalize_cm='true'):
+                     normalize_cm='true', search='grid', cv=None, n_iter=10,
+                     factor=3, random_state=None, cache_dir=None,
+                     cache_max_bytes=2 * 1024 ** 3):
     """
     Uses provided `clf_pipe` and `grid_params` to perform a GridSearchCV on best
     params according to specified `scoring` metric. See sklearn documentation 
@@ -163,19 +416,54 @@ def clf_gridsearch_wpipe(clf_pipe, grid_params, X_train, y_train, X_test, y_test
     Once best estimator is found, both the best estimator and the entire 
     GridSearchCV object are dumped to file using joblib. `file_name` and 
     `save_path` used in this exporting to file.
+
+    Each candidate's mean CV score and fit time is printed, best first.
     
     normalize_cm: string, default `true`. Setting for whether and how to
     normalize the confusion matrix. See sklearn documentation for options.
+
+    search: string, default `grid`. `grid` tries every combination in
+    `grid_params`. `random` tries `n_iter` random combinations (lists in
+    `grid_params` can be replaced with scipy distributions). `halving` and
+    `halving_random` use successive halving: every candidate is scored on a
+    small sample of the training data, and only the best 1/`factor` are
+    rerun on `factor` times as much data, until the best are fit on all of
+    it.
+
+    cv, n_iter, factor, random_state: passed to the sklearn search object.
+
+    cache_dir: string (optional). Directory to cache fit transformers in.
+    When set, each fold's fit of the steps before `clf` (i.e. the
+    vectorizers in `cols_trans`) is saved, and reused by every candidate that
+    only changes `clf` params, instead of being refit each time. Once the
+    search is done, least recently used fits are deleted until the cache
+    fits in `cache_max_bytes`.
     """
-    gs = GridSearchCV(clf_pipe, grid_params, n_jobs=n_jobs, verbose=verbose,
-                         scoring=scoring)
+    if cache_dir is not None:
+        memory = joblib.Memory(cache_dir, verbose=0)
+        clf_pipe = clone(clf_pipe).set_params(memory=memory)
+
+    gs = _make_search(search, clf_pipe, grid_params, scoring, n_jobs, verbose,
+                      cv, n_iter, factor, random_state)
+    if gs is None:
+        print("Error: search must be 'grid', 'random', 'halving' or "
+              "'halving_random'.")
+        return None
 
     # run the gridsearch
     gs.fit(X_train, y_train)
 
+    if cache_dir is not None:
+        memory.reduce_size(bytes_limit=cache_max_bytes)
+        # don't save a reference to the cache with the model
+        gs.estimator.set_params(memory=None)
+        gs.best_estimator_.set_params(memory=None)
+
     # print best estimator params and score
     print(gs.best_estimator_)
     print(gs.best_score_)
+    print()
+    print(candidate_fit_times(gs).to_string())
 
     # dump out best estimator and gs object to gdrive
     joblib.dump(gs.best_estimator_.named_steps['clf'], 
@@ -238,9 +526,23 @@ def custom_confusion_matrix(df, title):
         ax.set_title(title);
 
 
+@lru_cache(maxsize=4096)
+def _t_critical(df, alpha):
+    """Student's T critical value for a two-sided `alpha` interval."""
+    return st.t.ppf((1 + alpha) / 2, df)
+
+
 def calc_conf_interval(mn, se, n, alpha=0.95):
     """Calculates confidence interval for a sample mean using student's T.
     Assumes sample mean has already been calculated and we have n. 
+
+    Takes either single values, returning `[low, high]`, or arrays or
+    Series (i.e. one per feature), returning `[low, high]` as arrays or as
+    Series with the same index as `mn`. Critical values are only looked up
+    once per sample size.
+
+    Where n is 1 or less, or se is 0, the interval is just the mean. Where
+    se or n is missing, both bounds are missing.
     
     mn: Sample mean
     
@@ -250,10 +552,190 @@ def calc_conf_interval(mn, se, n, alpha=0.95):
     
     alpha: Ratio for confidence interval
     """
-    
-    if n > 1 and se > 0:
-        conf = st.t.interval(alpha=alpha, df=n-1, loc=mn, scale=se)
-    else:
-        conf = (mn, mn)
-    return list(conf)
+    if np.ndim(mn) == 0 and np.ndim(se) == 0 and np.ndim(n) == 0:
+        if pd.isna(se) or pd.isna(n):
+            conf = (np.nan, np.nan)
+        elif n > 1 and se > 0:
+            margin = _t_critical(int(n) - 1, alpha) * se
+            conf = (mn - margin, mn + margin)
+        else:
+            conf = (mn, mn)
+        return list(conf)
+
+    mn_arr, se_arr, n_arr = np.broadcast_arrays(
+        np.asarray(mn, dtype=np.float64), np.asarray(se, dtype=np.float64),
+        np.asarray(n, dtype=np.float64))
+    has_n = ~np.isnan(n_arr)
+    n_arr = np.where(has_n, n_arr, 0).astype(np.int64)
+
+    # look up each distinct sample size's critical value once
+    sizes, inverse = np.unique(n_arr, return_inverse=True)
+    t_crit = np.array([_t_critical(int(size) - 1, alpha) if size > 1
+                       else np.nan for size in sizes])[inverse]
+    t_crit = t_crit.reshape(n_arr.shape)
+
+    margin = np.where((n_arr > 1) & (se_arr > 0), t_crit * se_arr, 0.0)
+    margin[~has_n | np.isnan(se_arr)] = np.nan
+    low, high = mn_arr - margin, mn_arr + margin
+
+    if isinstance(mn, pd.Series):
+        low = pd.Series(low, index=mn.index, name=mn.name)
+        high = pd.Series(high, index=mn.index, name=mn.name)
+    return [low, high]
+
+
+def bootstrap_conf_interval(samples, alpha=0.95, axis=0):
+    """Calculates bootstrap percentile confidence intervals, i.e. the middle
+    `alpha` of a statistic's values across resampled fits. Missing values
+    (i.e. a feature that wasn't in every fit) are ignored.
+
+    samples: array or dataframe of the statistic, with one row per resample
+    and one column per feature (for `axis=0`)
+
+    alpha: Ratio for confidence interval
+
+    Returns `[low, high]` as arrays, or as Series indexed on the columns if
+    `samples` is a dataframe.
+    """
+    tail = (1 - alpha) / 2 * 100
+    low, high = np.nanpercentile(np.asarray(samples, dtype=np.float64),
+                                 [tail, 100 - tail], axis=axis)
+
+    if isinstance(samples, pd.DataFrame) and axis == 0:
+        low = pd.Series(low, index=samples.columns)
+        high = pd.Series(high, index=samples.columns)
+    return [low, high]
+
+
+def _pipe_feature_names(pipe):
+    """Returns the names of the features the last step of a fit pipeline is
+    trained on, i.e. `ohe__post_type_photo` or `txt__climate change`.
+    """
+    transformers = pipe[:-1]
+    if hasattr(transformers, 'get_feature_names_out'):
+        return np.asarray(transformers.get_feature_names_out(), dtype=object)
+    # get_feature_names was renamed in sklearn 1.0, and pipelines never had
+    # it, so ask the last transformer (i.e. a ColumnTransformer) instead
+    return np.asarray(transformers[-1].get_feature_names(), dtype=object)
+
+
+def _fit_resample(clf_pipe, X, y, train_size, seed):
+    """Fits a clone of `clf_pipe` on a random `train_size` share of the rows,
+    sampled without replacement. Returns the feature names, the coefficients
+    (one row per class, or one row if binary) and the classes.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = len(y)
+    idx = np.sort(rng.choice(n_rows, size=int(round(train_size * n_rows)),
+                             replace=False))
+
+    X_sample = X.iloc[idx] if hasattr(X, 'iloc') else X[idx]
+    y_sample = y.iloc[idx] if hasattr(y, 'iloc') else np.asarray(y)[idx]
+
+    pipe = clone(clf_pipe)
+    pipe.fit(X_sample, y_sample)
+    clf = pipe[-1]
+    return (_pipe_feature_names(pipe), np.atleast_2d(clf.coef_),
+            np.asarray(clf.classes_))
+
+
+def bootstrap_odds_ratios(clf_pipe, X, y, n_resamples=10, train_size=0.9,
+                          alpha=0.95, ci='t', n_jobs=-1, random_state=None,
+                          verbose=0):
+    """Fits `clf_pipe` on `n_resamples` random samples of the data (each
+    `train_size` of the rows, sampled without replacement) in parallel
+    processes, and aggregates the odds ratios of every feature across fits.
+
+    The pipeline's transformers are refit on every sample, so vocabularies
+    (i.e. the top 2000 n-grams) differ between fits. Coefficients are
+    aligned on the union of all fits' features; a feature's statistics only
+    use the fits it appeared in.
+
+    Returns a dataframe with one row per feature (per class for multi-class
+    models, with a `class` column), sorted by mean odds ratio, with columns:
+    - `odds_ratio`: mean of exp(coef) across fits
+    - `std_err`: standard error of the mean odds ratio
+    - `ci_low`, `ci_high`: confidence interval for the mean odds ratio
+    - `n_fits`: number of fits the feature appeared in
+
+    *** Arguments
+
+    clf_pipe: unfit pipeline whose last step is a linear classifier with
+    `coef_`, i.e. the best pipeline from `clf_gridsearch_wpipe`.
 
+    X, y: full dataset to sample from.
+
+    alpha: Ratio for confidence interval
+
+    ci: string, default `t`. `t` uses student's T with the standard error
+    (see `calc_conf_interval`); `percentile` uses the spread of odds ratios
+    across fits (see `bootstrap_conf_interval`), which needs more resamples
+    to be stable.
+
+    n_jobs: int, default -1. Number of fits to run at once; -1 uses all
+    cores.
+
+    random_state: int (optional). Seed for reproducible samples.
+    """
+    seeds = np.random.SeedSequence(random_state).spawn(n_resamples)
+    fits = joblib.Parallel(n_jobs=n_jobs, verbose=verbose)(
+        joblib.delayed(_fit_resample)(clf_pipe, X, y, train_size, seed)
+        for seed in seeds)
+
+    classes = fits[0][2]
+    n_rows = fits[0][1].shape[0]
+
+    # map every fit's features onto the union vocabulary
+    vocab = {}
+    fit_cols = [np.fromiter((vocab.setdefault(name, len(vocab))
+                             for name in names), dtype=np.int64,
+                            count=len(names))
+                for names, _, _ in fits]
+    features = np.array(list(vocab), dtype=object)
+    shape = (n_resamples, len(features))
+
+    rows = np.concatenate([np.full(len(cols), i)
+                           for i, cols in enumerate(fit_cols)])
+    cols = np.concatenate(fit_cols)
+    present = sparse.csr_matrix((np.ones(len(cols)), (rows, cols)),
+                                shape=shape)
+    n_fits = np.asarray(present.sum(axis=0)).ravel()
+
+    results = []
+    for class_idx in range(n_rows):
+        values = np.concatenate([np.exp(coef[class_idx])
+                                 for _, coef, _ in fits])
+        odds = sparse.csr_matrix((values, (rows, cols)), shape=shape)
+
+        total = np.asarray(odds.sum(axis=0)).ravel()
+        total_sq = np.asarray(odds.multiply(odds).sum(axis=0)).ravel()
+        mean = total / n_fits
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = (total_sq - n_fits * mean ** 2) / (n_fits - 1)
+            std_err = np.where(n_fits > 1,
+                               np.sqrt(np.clip(var, 0, None) / n_fits), 0.0)
+
+        if ci == 'percentile':
+            # dense, with missing features as NaN so they're ignored
+            dense = np.full(shape, np.nan)
+            dense[rows, cols] = values
+            ci_low, ci_high = bootstrap_conf_interval(dense, alpha=alpha)
+        else:
+            ci_low, ci_high = calc_conf_interval(mean, std_err, n_fits,
+                                                 alpha=alpha)
+
+        df = pd.DataFrame({'feature': features, 'odds_ratio': mean,
+                           'std_err': std_err, 'ci_low': ci_low,
+                           'ci_high': ci_high,
+                           'n_fits': n_fits.astype(np.int64)})
+        if n_rows > 1:
+            df.insert(1, 'class', classes[class_idx])
+        results.append(df)
+
+    df = pd.concat(results, ignore_index=True)
+    if n_rows > 1:
+        df = df.sort_values(['class', 'odds_ratio'], ascending=[True, False])
+    else:
+        df = df.sort_values('odds_ratio', ascending=False)
+    return df.reset_index(drop=True)
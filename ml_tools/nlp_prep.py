@@ -1,8 +1,17 @@
 import html
 import re
 import string
+import time
+from functools import lru_cache
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # before Python 3.11
+    import sre_parse
 import numpy as np
 import pandas as pd
+import joblib
+from scipy import sparse
 from wordcloud import WordCloud
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -11,6 +20,7 @@ from nltk.probability import FreqDist
 from nltk.tokenize import TweetTokenizer, sent_tokenize
 from nltk.stem.wordnet import WordNetLemmatizer
 from nltk.stem.porter import PorterStemmer
+from sklearn.feature_extraction.text import CountVectorizer
 
 def clean_docs(doc):
     """
@@ -55,6 +65,155 @@ def clean_docs(doc):
     
     return doc
 
+# compiled versions of the patterns used in `clean_docs`, for the batch API
+_url_re = re.compile(r"http[^ ]+|www\.[^ ]+")
+_periods_re = re.compile(r"[.]+")
+_spaced_periods_re = re.compile(r"(\. \.)")
+_multi_spaces_re = re.compile(r"[ ]{2,}")
+_unicode_punctuation = {0x2018:0x27, 0x2019:0x27, 0x201C:0x22, 0x201D:0x22}
+
+def _remove_urls(doc):
+    """Removes URLs the way `clean_docs` does, in a single substitution when
+    that gives the same result.
+    
+    `clean_docs` replaces every occurrence of each URL string in turn, which
+    also hits copies of a URL inside other text. A single substitution of 
+    the matches is only identical when every match is a whole space 
+    delimited token and no URL is contained in another, so the per-URL 
+    replacement is kept as a fallback.
+    """
+    matches = list(_url_re.finditer(doc))
+    if not matches:
+        return doc
+    
+    urls = set()
+    whole_tokens = True
+    for match in matches:
+        start = match.start()
+        if start > 0 and doc[start - 1] != ' ':
+            whole_tokens = False
+            break
+        urls.add(match.group())
+    
+    if whole_tokens and not any(url != other and url in other 
+                                for url in urls for other in urls):
+        return _url_re.sub(' ', doc)
+    
+    for match in matches:
+        doc = str.replace(doc, match.group(), ' ')
+    return doc
+
+def _clean_doc_fast(doc):
+    """Same steps as `clean_docs` using the precompiled patterns, skipping 
+    any step that can't change the document.
+    """
+    if not isinstance(doc, str):
+        return doc
+    
+    if '&' in doc:
+        doc = html.unescape(doc)
+    
+    if 'http' in doc or 'www.' in doc:
+        doc = _remove_urls(doc)
+    
+    if not doc.isascii():
+        doc = doc.translate(_unicode_punctuation).encode('ascii', 
+                                                          'ignore').decode()
+    
+    if '..' in doc:
+        doc = _periods_re.sub('.', doc)
+    if '. .' in doc:
+        doc = _spaced_periods_re.sub('.', doc)
+    if '  ' in doc:
+        doc = _multi_spaces_re.sub(' ', doc)
+    
+    return doc
+
+def clean_docs_batch(docs, engine='python'):
+    """Applies the `clean_docs` cleaning steps to a whole series of 
+    documents, producing exactly the same text. Values that aren't strings 
+    (i.e. NaN) are passed through unchanged.
+    
+    Patterns are compiled once, URLs are removed in one substitution, and 
+    steps are skipped for documents without any `&`, URLs, non-ASCII 
+    characters, repeated periods or repeated spaces.
+    
+    Returns a Series with the same index as `docs`, or a list if `docs` is
+    not a Series.
+    
+    engine: string, default `python`. Use `python` to clean one document at
+    a time with the fast path above. Use `pandas` to run each step as a
+    pandas string method over only the rows that need it.
+    """
+    if engine == 'python':
+        cleaned = [_clean_doc_fast(doc) for doc in docs]
+        if isinstance(docs, pd.Series):
+            return pd.Series(cleaned, index=docs.index, name=docs.name, 
+                             dtype=object)
+        return cleaned
+    elif engine != 'pandas':
+        print("Error: `engine` should be 'python' or 'pandas'.")
+        return None
+    
+    is_series = isinstance(docs, pd.Series)
+    cleaned = pd.Series(docs, dtype=object).copy()
+    is_str = cleaned.map(lambda doc: isinstance(doc, str))
+    
+    # run each step only on the string rows it could change
+    mask = is_str & cleaned.str.contains('&', regex=False, na=False)
+    cleaned[mask] = cleaned[mask].map(html.unescape)
+    
+    mask = is_str & cleaned.str.contains(r"http|www\.", na=False)
+    cleaned[mask] = cleaned[mask].map(_remove_urls)
+    
+    mask = is_str & ~cleaned.map(lambda doc: isinstance(doc, str) 
+                                 and doc.isascii())
+    cleaned[mask] = cleaned[mask].str.translate(_unicode_punctuation)\
+                                 .str.encode('ascii', 'ignore')\
+                                 .str.decode('ascii')
+    
+    for regex, check, repl in [(_periods_re, '..', '.'), 
+                               (_spaced_periods_re, '. .', '.'), 
+                               (_multi_spaces_re, '  ', ' ')]:
+        mask = is_str & cleaned.str.contains(check, regex=False, na=False)
+        cleaned[mask] = cleaned[mask].str.replace(regex, repl, regex=True)
+    
+    if is_series:
+        return cleaned
+    return cleaned.tolist()
+
+def benchmark_clean_docs(docs, repeats=3):
+    """Times `clean_docs` applied one document at a time against both 
+    engines of `clean_docs_batch`, and checks that all three produce
+    identical text. `docs` should be a Series or list of strings.
+    
+    Returns a dataframe with one row per method showing the best time out 
+    of `repeats` runs in seconds, and the throughput in docs per second.
+    """
+    docs = pd.Series(docs, dtype=object)
+    
+    methods = {
+        'clean_docs': lambda: [clean_docs(doc) for doc in docs],
+        'batch_python': lambda: clean_docs_batch(docs, engine='python').tolist(),
+        'batch_pandas': lambda: clean_docs_batch(docs, engine='pandas').tolist()
+    }
+    
+    results = []
+    outputs = {}
+    for name, func in methods.items():
+        secs, outputs[name] = _time_call(func, repeats=repeats)
+        results.append([name, len(docs), secs, len(docs) / secs])
+    
+    df_bench = pd.DataFrame(results, columns=['method', 'docs', 'seconds', 
+                                              'docs_per_sec'])
+    df_bench['speedup'] = df_bench.at[0, 'seconds'] / df_bench['seconds']
+    
+    for name in ['batch_python', 'batch_pandas']:
+        if outputs[name] != outputs['clean_docs']:
+            print(f"Warning: {name} output differs from clean_docs.")
+    
+    return df_bench
+
 def get_pattern_hits(doc, pattern, out_type):
     """Takes in a regex pattern and a string of text, and checks for the 
     presence of the pattern in the string. 
@@ -120,8 +279,55 @@ def get_pattern_hits(doc, pattern, out_type):
                  
     return doc, hits
 
+def _batch_pattern_hits(docs, pattern, out_type):
+    """Columnar version of `get_pattern_hits`. Compiles `pattern` once and
+    runs it over an iterable of documents.
+    
+    Returns two lists, the new documents and the hits, in the same order as 
+    `docs`. Documents that aren't strings (i.e. NaN) are passed through 
+    unchanged with `None` as their hits, matching `pattern_match_in_df`.
+    """
+    regex = re.compile(pattern)
+    findall = regex.findall
+    sub = regex.sub
+    spaces_sub = re.compile(r"(\s{2,})").sub
+    
+    new_docs = []
+    hits_out = []
+    
+    for doc in docs:
+        if not isinstance(doc, str):
+            new_docs.append(doc)
+            hits_out.append(None)
+            continue
+        
+        pattern_hits = findall(doc)
+        
+        if pattern_hits:
+            # same replacement steps as `get_pattern_hits`, but only run
+            # when there is something to replace
+            doc = spaces_sub(' ', sub(' ', doc))
+        
+        new_docs.append(doc)
+        hits_out.append(_format_hits(pattern_hits, out_type))
+    
+    return new_docs, hits_out
+
+def _format_hits(pattern_hits, out_type):
+    """Formats the list returned by `re.findall` the same way 
+    `get_pattern_hits` records hits for each `out_type`.
+    """
+    if out_type=='list':
+        return list(set(pattern_hits)) if pattern_hits else []
+    elif out_type=='string':
+        return ''.join([' ' + hit for hit in pattern_hits])
+    elif out_type=='bool':
+        return len(pattern_hits) > 0
+    else:
+        return None
+
 def pattern_match_in_df(df, doc_col, hit_col, pattern, out_type='list', 
-                        replace=True):
+                        replace=True, engine='loop'):
     """Loops through values in a particular dataframe columns, and searches
     for regex pattern matches. 
     
@@ -149,7 +355,20 @@ def pattern_match_in_df(df, doc_col, hit_col, pattern, out_type='list',
     If `replace=False`, the `doc_col` will not be updated, and matches will
     only be logged in the new `hit_col`.
     
+    engine: string, default `loop`. Use `loop` to process the dataframe row 
+    by row with `get_pattern_hits`. Use `vectorized` to compile the pattern 
+    once and process the whole column at a time, assigning the results
+    straight back to the dataframe instead of joining. Both engines return 
+    the same values and column order. See `benchmark_pattern_match` to 
+    compare their speed.
     """
+    if engine == 'vectorized':
+        return _pattern_match_vectorized(df, doc_col, hit_col, pattern, 
+                                         out_type, replace)
+    elif engine != 'loop':
+        print("Error: `engine` should be 'loop' or 'vectorized'.")
+        return None
+    
     updates = []
     
     # loop through each row in the dataframe to process its record
@@ -184,6 +403,363 @@ def pattern_match_in_df(df, doc_col, hit_col, pattern, out_type='list',
             
     return df
 
+def _pattern_match_vectorized(df, doc_col, hit_col, pattern, out_type, 
+                              replace):
+    """Vectorized engine for `pattern_match_in_df`. Keeps the column layout
+    of the loop engine: a replaced `doc_col` moves to the end of the 
+    dataframe, followed by `hit_col`.
+    """
+    if out_type=='none' and not replace:
+        print("Dataframe was returned as-is based on arguments passed.")
+        return df
+    
+    new_docs, hits = _batch_pattern_hits(df[doc_col].values, pattern, 
+                                         out_type)
+    
+    if replace:
+        df = df.drop(columns=[doc_col])
+        df[doc_col] = pd.Series(new_docs, index=df.index, dtype=object)
+    else:
+        df = df.copy()
+    
+    if out_type!='none':
+        # let pandas infer the dtype, as the DataFrame constructor does in
+        # the loop engine (i.e. all booleans become a bool column)
+        df[hit_col] = pd.Series(hits, index=df.index)
+    
+    return df
+
+# regex class escapes for the categories `sre_parse` reports
+_CATEGORY_ESCAPES = {'CATEGORY_DIGIT': r'\d', 'CATEGORY_NOT_DIGIT': r'\D',
+                     'CATEGORY_SPACE': r'\s', 'CATEGORY_NOT_SPACE': r'\S',
+                     'CATEGORY_WORD': r'\w', 'CATEGORY_NOT_WORD': r'\W'}
+
+def _first_chars(items):
+    """Returns a list of character class parts (i.e. `h`, `a-z`, `\\d`) that
+    any match of the parsed pattern `items` must start with, or None if it
+    can't be worked out (i.e. it can start with any character, or match an
+    empty string).
+    """
+    for op, av in items:
+        name = str(op)
+        if name == 'AT':
+            # anchors like \b and ^ don't use up a character
+            continue
+        if name == 'LITERAL':
+            return [re.escape(chr(av))]
+        if name == 'IN':
+            parts = []
+            for set_op, set_av in av:
+                set_name = str(set_op)
+                if set_name == 'LITERAL':
+                    parts.append(re.escape(chr(set_av)))
+                elif set_name == 'RANGE':
+                    parts.append(f"{re.escape(chr(set_av[0]))}-"
+                                 f"{re.escape(chr(set_av[1]))}")
+                elif set_name == 'CATEGORY' and \
+                        str(set_av) in _CATEGORY_ESCAPES:
+                    parts.append(_CATEGORY_ESCAPES[str(set_av)])
+                else:
+                    # negated sets and anything else
+                    return None
+            return parts
+        if name == 'SUBPATTERN':
+            group, add_flags, del_flags, sub_items = av
+            if add_flags or del_flags:
+                return None
+            return _first_chars(sub_items)
+        if name == 'BRANCH':
+            parts = []
+            for branch in av[1]:
+                branch_parts = _first_chars(branch)
+                if branch_parts is None:
+                    return None
+                parts.extend(branch_parts)
+            return parts
+        if name in ['MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT']:
+            if av[0] == 0:
+                return None
+            return _first_chars(av[2])
+        return None
+    return None
+
+def _combine_patterns(patterns, separate):
+    """Combines the patterns not in `separate` into one regex alternating
+    between them, with an empty named group at the end of each pattern to
+    tell which one matched, i.e. `http...(?P<_p0>)|@\\w+(?P<_p1>)`, so one
+    scan finds the matches of all of them.
+    
+    The regex engine only skips quickly to where a match can start when
+    every alternative starts with a literal character, so a group around a
+    whole pattern (i.e. `(http...)`) is left out, since it holds the same
+    text as the match. If some pattern doesn't start with a literal, a
+    lookahead of the characters matches can start with (i.e. `(?=[h@\\d])`)
+    is added in front instead, where they can be worked out.
+    
+    Returns the combined regex (None if fewer than two patterns can be
+    combined), a dict of each pattern's end group number to (hit column,
+    number of its first group, number of groups in the pattern), and the
+    list of hit columns to search separately.
+    """
+    separate = list(separate or [])
+    parts = []
+    for hit_col, pattern in patterns.items():
+        if hit_col in separate:
+            continue
+        # backreferences would be renumbered, inline global flags would
+        # apply to every pattern, and empty matches can't be told apart
+        if re.search(r"\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)", pattern):
+            separate.append(hit_col)
+            continue
+        try:
+            parsed = sre_parse.parse(pattern)
+        except re.error:
+            separate.append(hit_col)
+            continue
+        if parsed.getwidth()[0] == 0:
+            separate.append(hit_col)
+            continue
+        
+        items = parsed.data
+        if (pattern.startswith('(') and not pattern.startswith('(?') and
+                pattern.endswith(')') and parsed.state.groups == 2 and
+                len(items) == 1 and str(items[0][0]) == 'SUBPATTERN'):
+            # one group around the whole pattern
+            pattern = pattern[1:-1]
+            items = items[0][1][3].data
+        parts.append((hit_col, pattern, items))
+    
+    if len(parts) < 2:
+        return None, {}, list(patterns)
+    
+    groups = {}
+    combined = []
+    group_num = 1
+    for i, (hit_col, pattern, items) in enumerate(parts):
+        n_groups = re.compile(pattern).groups
+        groups[group_num + n_groups] = (hit_col, group_num, n_groups)
+        combined.append(f"{pattern}(?P<_p{i}>)")
+        group_num += n_groups + 1
+    combined = '|'.join(combined)
+    
+    if not all(len(items) > 0 and str(items[0][0]) == 'LITERAL'
+               for hit_col, pattern, items in parts):
+        starts = [_first_chars(items) for hit_col, pattern, items in parts]
+        if all(start is not None for start in starts):
+            chars = ''.join(dict.fromkeys(part for start in starts
+                                          for part in start))
+            combined = f"(?=[{chars}])(?:{combined})"
+    try:
+        combined = re.compile(combined)
+    except re.error:
+        # i.e. the same group name in two patterns
+        return None, {}, list(patterns)
+    combinable = [hit_col for hit_col, pattern, items in parts]
+    return combined, groups, [hit_col for hit_col in patterns
+                              if hit_col not in combinable]
+
+def multi_pattern_match_in_df(df, doc_col, patterns, out_type='list', 
+                              replace=True, separate=None):
+    """Searches a dataframe column for several regex patterns with a single
+    scan of each document, instead of one `pattern_match_in_df` call (one
+    scan and one join) per pattern.
+    
+    The patterns are combined into one regex alternating between them (see
+    `_combine_patterns`), and each match is credited to the pattern whose
+    named group matched. With `replace=True`, the matches are replaced in
+    the same scan that finds them.
+    Since the combined regex finds non-overlapping matches, this gives the
+    same hits as separate calls only for patterns whose matches never
+    overlap another pattern's, i.e. links to different domains. Patterns
+    that can overlap (i.e. a date inside a link) should be listed in
+    `separate`, and are searched on their own as `pattern_match_in_df`
+    would. Patterns using backreferences or inline global flags like `(?i)`
+    are always searched separately, and all of them are if the patterns
+    can't be combined (i.e. two define the same group name).
+    
+    Returns the same dataframe with one new column per pattern, in the
+    order of `patterns`. Use `benchmark_multi_pattern_match` to check the
+    hits against separate `pattern_match_in_df` calls and compare speed.
+    
+    *** Arguments
+    
+    df: Dataframe containing the `doc_col` to be searched.
+    
+    doc_col: String. Name of the dataframe column containing the text to be
+    searched for the patterns.
+    
+    patterns: dict. Keys are the names of the hit columns to add to the
+    dataframe, and values are the regex patterns to search for. For example:
+    
+        {'message_link1': r"(http[s]?://nyti.ms/[A-Za-z0-9/.]+)",
+         'message_link2': r"(http[s]?://nytimes/[A-Za-z0-9/.-_]+)"}
+    
+    out_type: string or dict, default `list`. See `get_pattern_hits` 
+    documentation for details. Pass a dict keyed on hit column name to use
+    a different `out_type` per pattern.
+    
+    replace: Boolean, default True. As for `pattern_match_in_df`, use
+    `replace=True` to have the matches replaced with spaces in `doc_col`.
+    Matches of the combined patterns are replaced together, then each
+    pattern in `separate` searches and replaces in order on the text left.
+    
+    separate: list (optional). Hit columns whose patterns should be searched
+    on their own, after the combined ones.
+    """
+    if type(out_type) == str:
+        out_types = {hit_col: out_type for hit_col in patterns}
+    else:
+        out_types = out_type
+    
+    combined, groups, separate = _combine_patterns(patterns, separate)
+    separate_compiled = [(hit_col, re.compile(patterns[hit_col]))
+                         for hit_col in separate]
+    spaces_sub = re.compile(r"(\s{2,})").sub
+    found = []
+    
+    def record_hit(match):
+        found.append(match)
+        return ' '
+    
+    new_docs = []
+    hits = {hit_col: [] for hit_col in patterns}
+    
+    for doc in df[doc_col].values:
+        if not isinstance(doc, str):
+            new_docs.append(doc)
+            for hit_col in patterns:
+                hits[hit_col].append(None)
+            continue
+        
+        if combined is not None:
+            doc_hits = {hit_col: [] for hit_col, _, _ in groups.values()}
+            found.clear()
+            if replace:
+                # find and replace the matches in the same scan
+                new_doc, n_subs = combined.subn(record_hit, doc)
+                if n_subs > 0:
+                    doc = spaces_sub(' ', new_doc)
+            else:
+                found.extend(combined.finditer(doc))
+            
+            # credit each match to the pattern whose end group matched, with
+            # the value `re.findall` gives for that pattern alone
+            for match in found:
+                hit_col, first, n_groups = groups[match.lastindex]
+                if n_groups == 0:
+                    hit = match[0]
+                elif n_groups == 1:
+                    hit = match[first] or ''
+                else:
+                    hit = tuple(group or '' for group in
+                                match.groups()[first - 1:first - 1 + n_groups])
+                doc_hits[hit_col].append(hit)
+            
+            for hit_col, pattern_hits in doc_hits.items():
+                hits[hit_col].append(_format_hits(pattern_hits,
+                                                  out_types[hit_col]))
+        
+        for hit_col, regex in separate_compiled:
+            pattern_hits = regex.findall(doc)
+            if pattern_hits and replace:
+                doc = spaces_sub(' ', regex.sub(' ', doc))
+            hits[hit_col].append(_format_hits(pattern_hits, 
+                                              out_types[hit_col]))
+        new_docs.append(doc)
+    
+    if replace:
+        df = df.drop(columns=[doc_col])
+        df[doc_col] = pd.Series(new_docs, index=df.index, dtype=object)
+    else:
+        df = df.copy()
+    
+    for hit_col in patterns:
+        if out_types[hit_col] != 'none':
+            df[hit_col] = pd.Series(hits[hit_col], index=df.index)
+    
+    return df
+
+def _time_call(func, repeats=3):
+    """Runs `func` with no arguments `repeats` times and returns the best
+    wall clock time in seconds, along with the result of the last run.
+    """
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def benchmark_pattern_match(df, doc_col, pattern, out_type='list', 
+                            replace=True, repeats=3):
+    """Times the `loop` and `vectorized` engines of `pattern_match_in_df` on
+    the same dataframe, and checks that they return the same output.
+    
+    Returns a dataframe with one row per engine showing the best time out of
+    `repeats` runs in seconds, and the throughput in rows per second.
+    """
+    results = []
+    outputs = {}
+    for engine in ['loop', 'vectorized']:
+        secs, out = _time_call(
+            lambda: pattern_match_in_df(df, doc_col, 'hits', pattern, 
+                                        out_type=out_type, replace=replace, 
+                                        engine=engine), 
+            repeats=repeats)
+        outputs[engine] = out
+        results.append([engine, len(df), secs, len(df) / secs])
+    
+    df_bench = pd.DataFrame(results, columns=['engine', 'rows', 'seconds', 
+                                              'rows_per_sec'])
+    df_bench['speedup'] = df_bench.at[0, 'seconds'] / df_bench['seconds']
+    
+    if not outputs['loop'].equals(outputs['vectorized']):
+        print("Warning: engines returned different output.")
+    
+    return df_bench
+
+def benchmark_multi_pattern_match(df, doc_col, patterns, out_type='list',
+                                  replace=True, separate=None, repeats=3):
+    """Times `multi_pattern_match_in_df` against one `pattern_match_in_df`
+    call (`vectorized` engine) per pattern, on the same dataframe, and
+    checks that they return the same hits and documents.
+    
+    Returns a dataframe with one row per method showing the best time out of
+    `repeats` runs in seconds, and the throughput in rows per second.
+    """
+    def separate_calls():
+        out = df
+        for hit_col, pattern in patterns.items():
+            out = pattern_match_in_df(out, doc_col, hit_col, pattern,
+                                      out_type=out_type, replace=replace,
+                                      engine='vectorized')
+        return out
+    
+    results = []
+    outputs = {}
+    for method, func in [
+            ('separate', separate_calls),
+            ('multi', lambda: multi_pattern_match_in_df(
+                df, doc_col, patterns, out_type=out_type, replace=replace,
+                separate=separate))]:
+        secs, out = _time_call(func, repeats=repeats)
+        outputs[method] = out
+        results.append([method, len(df), secs, len(df) / secs])
+    
+    df_bench = pd.DataFrame(results, columns=['method', 'rows', 'seconds', 
+                                              'rows_per_sec'])
+    df_bench['speedup'] = df_bench.at[0, 'seconds'] / df_bench['seconds']
+    
+    cols = sorted(outputs['separate'].columns)
+    if not outputs['separate'][cols].equals(outputs['multi'][cols]):
+        print("Warning: methods returned different output. List patterns "
+              "whose matches can overlap in `separate`.")
+    
+    return df_bench
+
 def generate_wordcloud(docs, cmap, stopwords, min_font_size=14, n_grams=True, 
                        title='Word cloud'):
     """Generate a wordcloud from a list of pre-tokenized words. Words will be
@@ -207,8 +783,15 @@ def generate_freqs_wordcloud(df, word_col, freq_col, cmap, min_font_size=14,
     """Generate a wordcloud from a dataframe where one column holds the words
     and another column holds the frequency or weight. The dictionary for the
     wordcloud is generated inside the function.
+    
+    `df` can also be a dictionary of word to frequency, such as one returned
+    by `term_freqs_per_class` with `as_dict=True`, in which case `word_col`
+    and `freq_col` are ignored.
     """
-    freq_dict = pd.Series(df[freq_col].values,index=df[word_col]).to_dict()
+    if isinstance(df, dict):
+        freq_dict = df
+    else:
+        freq_dict = pd.Series(df[freq_col].values,index=df[word_col]).to_dict()
     
     cloud = WordCloud(colormap=cmap, width=600, height=400, 
                       prefer_horizontal=0.95, min_font_size=min_font_size,
@@ -240,26 +823,112 @@ def plot_wordfreqs(df, word_col, freq_col, top_n, sub_title):
         ax.set_title(f"Top {top_n} Words\n{sub_title}")
 
 
-def tokenize_corpus_dict_tweet(df, target_vals, stop_list=None, 
-                               verbose=True, target_col='emotion',
-                              doc_col='cleaned'):
-    """ Tokenizes text and separates the tokens. Returns a dictionary where the
-    keys are target class labels and the values are a list of tokens within 
-    the labeled class.
-    
-    `df` is a Dataframe with the document text and labels, and `doc_col` is the
-    name of the column in which document text is stored.
+def build_doc_term_matrix(docs, stop_list=None, ngram_range=(1, 2), 
+                          min_df=1):
+    """Tokenizes a corpus once with TweetTokenizer and counts unigrams and 
+    bigrams (by default) into a sparse document-term matrix, so word and 
+    n-gram frequencies can be pulled for any subset of documents without
+    re-tokenizing.
     
-    `target_vals` should be a list of the class labels; labels in `target_col` 
-    but not in the `target_vals` list will be ignored.
+    Returns the scipy sparse CSR matrix (one row per document in `docs`) and
+    a numpy array of the terms for each column. Bigrams are joined with a 
+    space, i.e. `donald trump`.
     
-    If `stop_list` (type=list) provided, those words or tokens will be removed
-    from the returned dict.
+    If `stop_list` provided, those words or tokens are removed before 
+    n-grams are built. Terms in fewer than `min_df` documents are dropped.
     """
     tweettokenizer = TweetTokenizer(preserve_case=False, strip_handles=True)
+    
+    vect = CountVectorizer(tokenizer=tweettokenizer.tokenize, token_pattern=None,
+                           lowercase=False, stop_words=stop_list, 
+                           ngram_range=ngram_range, min_df=min_df, 
+                           dtype=np.int32)
+    dtm = vect.fit_transform(docs)
+    # get_feature_names was renamed in sklearn 1.0
+    if hasattr(vect, 'get_feature_names_out'):
+        terms = vect.get_feature_names_out()
+    else:
+        terms = np.array(vect.get_feature_names(), dtype=object)
+    
+    return dtm, terms
 
-    # generate corpus for each emotion
-    corpus_per_target = {}
+def term_freqs_per_class(dtm, terms, labels, target_vals, top_n=None, 
+                         n_gram=None, as_dict=False):
+    """Sums the columns of a document-term matrix from 
+    `build_doc_term_matrix` per target class, in a single sparse matrix 
+    product.
+    
+    Returns a dictionary where the keys are target class labels and the 
+    values are dataframes with `word` and `freq` columns, sorted by 
+    frequency descending. These can be passed straight to `plot_wordfreqs`
+    and `generate_freqs_wordcloud`.
+    
+    labels: array-like, with the target class of each row of `dtm`.
+    
+    target_vals: list of class labels to return frequencies for.
+    
+    top_n: int (optional). Only keep the `top_n` most frequent terms per 
+    class.
+    
+    n_gram: int (optional). Only keep terms made of this many words, i.e. 
+    `2` for bigrams only.
+    
+    as_dict: Boolean, default False. Return a {word: freq} dictionary per 
+    class instead of a dataframe.
+    """
+    labels = np.asarray(labels)
+    
+    # one row per class, with a 1 in each column whose document is in the
+    # class, so a single product gives the column sums for every class
+    class_rows = sparse.csr_matrix(
+        np.vstack([labels == val for val in target_vals]).astype(np.int32))
+    class_sums = np.asarray((class_rows @ dtm).todense())
+    
+    keep = np.ones(len(terms), dtype=bool)
+    if n_gram is not None:
+        keep = np.char.count(terms.astype(str), ' ') + 1 == n_gram
+    
+    freqs = {}
+    for i, val in enumerate(target_vals):
+        counts = class_sums[i]
+        cols = np.flatnonzero(keep & (counts > 0))
+        cols = cols[np.argsort(-counts[cols], kind='stable')]
+        if top_n is not None:
+            cols = cols[:top_n]
+        
+        df_freq = pd.DataFrame({'word': terms[cols], 'freq': counts[cols]})
+        if as_dict:
+            freqs[val] = dict(zip(df_freq['word'], df_freq['freq'].tolist()))
+        else:
+            freqs[val] = df_freq
+    
+    return freqs
+
+def iter_corpus_tokens_tweet(df, target_vals, stop_list=None, 
+                             verbose=False, target_col='emotion',
+                             doc_col='cleaned', vocab=None):
+    """Generator version of `tokenize_corpus_dict_tweet`. Tokenizes one 
+    document at a time and yields a `(target_val, tokens)` tuple per 
+    document, so the tokens for the whole corpus never need to be held in 
+    memory at once.
+    
+    Documents are yielded grouped by target value, in the order of 
+    `target_vals`. Labels in `target_col` but not in `target_vals` are
+    ignored.
+    
+    If `stop_list` provided, those words or tokens will be removed. The 
+    first token that is just a space is always removed, as in 
+    `tokenize_corpus_dict_tweet`.
+    
+    vocab: dict (optional). If provided, each token is replaced with an 
+    integer ID and `tokens` is yielded as a numpy int32 array. Tokens not yet
+    in `vocab` are added to it with the next free ID, so the same dict can
+    be shared across calls, and `list(vocab)` maps IDs back to tokens.
+    """
+    tweettokenizer = TweetTokenizer(preserve_case=False, strip_handles=True)
+    
+    # set lookups are O(1) per token, where list lookups scan the whole list
+    stop_set = frozenset(stop_list if stop_list is not None else [])
 
     for val in target_vals:
         
@@ -269,29 +938,84 @@ def tokenize_corpus_dict_tweet(df, target_vals, stop_list=None,
         # get series of text docs per target_val
         docs = df.loc[df[target_col]==val, doc_col]
 
-        # loop through docs and tokenize each one
-        corpus = []
-
         i = 0
         for doc in docs:
-            # tokenize using tweet tokenizer
-            tokens = tweettokenizer.tokenize(doc)
-            
-            # remove stop words if needed
-            if not stop_list == None:
-                tokens = [token for token in tokens if token not in stop_list]
+            tokens = [token for token in tweettokenizer.tokenize(doc) 
+                      if token not in stop_set]
             
             # remove words if they're just spaces!
-            tokens.remove(' ') if ' ' in tokens else None
+            if ' ' in tokens:
+                tokens.remove(' ')
             
-            corpus.extend(tokens)
+            if vocab is not None:
+                tokens = np.array([vocab.setdefault(token, len(vocab)) 
+                                   for token in tokens], dtype=np.int32)
+            
+            yield val, tokens
             i += 1
             
             if verbose and (i % 1000 == 0):
                 print(f"Processed {i} docs out of {len(docs)}...")
 
-        # add corpus to dict
-        corpus_per_target[val] = corpus
+def freqdist_per_target_tweet(df, target_vals, stop_list=None, 
+                              verbose=False, target_col='emotion', 
+                              doc_col='cleaned', vocab=None):
+    """Counts token frequencies per target class while streaming through the
+    corpus with `iter_corpus_tokens_tweet`, instead of building the full 
+    token lists with `tokenize_corpus_dict_tweet` first.
+    
+    Returns a dictionary where the keys are target class labels and the 
+    values are nltk FreqDists of the tokens within the labeled class. If 
+    `vocab` is provided, the FreqDists are keyed on integer token IDs; see 
+    `iter_corpus_tokens_tweet`.
+    
+    To plot the results with `plot_wordfreqs` or `generate_freqs_wordcloud`,
+    build a dataframe from the most common tokens, i.e.
+    `pd.DataFrame(freqs[val].most_common(25), columns=['word', 'freq'])`.
+    """
+    freqs = {val: FreqDist() for val in target_vals}
+    
+    for val, tokens in iter_corpus_tokens_tweet(df, target_vals, 
+                                                stop_list=stop_list,
+                                                verbose=verbose,
+                                                target_col=target_col,
+                                                doc_col=doc_col, vocab=vocab):
+        if vocab is not None:
+            tokens = tokens.tolist()
+        freqs[val].update(tokens)
+        
+    if verbose:
+        print(f"Done!")
+    return freqs
+
+def tokenize_corpus_dict_tweet(df, target_vals, stop_list=None, 
+                               verbose=True, target_col='emotion',
+                              doc_col='cleaned'):
+    """ Tokenizes text and separates the tokens. Returns a dictionary where the
+    keys are target class labels and the values are a list of tokens within 
+    the labeled class.
+    
+    `df` is a Dataframe with the document text and labels, and `doc_col` is the
+    name of the column in which document text is stored.
+    
+    `target_vals` should be a list of the class labels; labels in `target_col` 
+    but not in the `target_vals` list will be ignored.
+    
+    If `stop_list` (type=list) provided, those words or tokens will be removed
+    from the returned dict.
+    
+    For large corpora, see `iter_corpus_tokens_tweet` and 
+    `freqdist_per_target_tweet`, which don't hold every token in memory.
+    """
+    # generate corpus for each emotion
+    corpus_per_target = {val: [] for val in target_vals}
+
+    for val, tokens in iter_corpus_tokens_tweet(df, target_vals, 
+                                                stop_list=stop_list,
+                                                verbose=verbose,
+                                                target_col=target_col,
+                                                doc_col=doc_col):
+        corpus_per_target[val].extend(tokens)
         
     if verbose:
         print(f"Done!")
@@ -316,6 +1040,66 @@ def pos_converter(penntree_pos):
     else:          
         return None
 
+# tokenizer and lemmatizer instances shared by the tokenize_lemma functions,
+# so they aren't rebuilt for every document
+_tweettokenizer = TweetTokenizer(preserve_case=False, strip_handles=True)
+_lemmatizer = WordNetLemmatizer()
+
+# maximum number of (token, wordnet POS) lemmas to keep in memory per process;
+# read on each `tokenize_lemma_corpus` call, so it can be changed at any time
+LEMMA_CACHE_SIZE = 2 ** 18
+
+@lru_cache(maxsize=None)
+def _wordnet_pos(penntree_pos):
+    """Memoized `pos_converter`; there are only a few dozen Penn Treebank 
+    tags.
+    """
+    return pos_converter(penntree_pos)
+
+_cached_lemma = None
+
+def _lemma_cache(cache_size):
+    """Returns `_lemmatizer.lemmatize` wrapped in a cache on (token, wordnet
+    POS), since headline and post vocabulary repeats heavily. The cache is
+    built on first use, and rebuilt (empty) if `cache_size` has changed.
+    """
+    global _cached_lemma
+    if _cached_lemma is None or \
+            _cached_lemma.cache_parameters()['maxsize'] != cache_size:
+        _cached_lemma = lru_cache(maxsize=cache_size)(_lemmatizer.lemmatize)
+    return _cached_lemma
+
+def _tokenize_lemma_chunk(docs, cache_size=None):
+    """Tokenizes and lemmatizes a list of documents. All sentences in the 
+    chunk are POS tagged in one batch, then regrouped per document.
+    
+    Returns a list with one list of lemmas per document. Lemmas are cached
+    up to `cache_size` entries (`LEMMA_CACHE_SIZE` if None).
+    """
+    cached_lemma = _lemma_cache(LEMMA_CACHE_SIZE if cache_size is None
+                                else cache_size)
+    sents_per_doc = [sent_tokenize(doc) for doc in docs]
+    
+    tokenized = [_tweettokenizer.tokenize(sent) 
+                 for sents in sents_per_doc for sent in sents]
+    pos_tagged = nltk.pos_tag_sents(tokenized)
+    
+    corpus_lemmas = []
+    start = 0
+    for sents in sents_per_doc:
+        lemmas = []
+        for sent in pos_tagged[start:start + len(sents)]:
+            for token, tag in sent:
+                wordnet_pos = _wordnet_pos(tag)
+                if wordnet_pos is not None:
+                    lemmas.append(cached_lemma(token, wordnet_pos))
+                else:
+                    lemmas.append(token)
+        corpus_lemmas.append(lemmas)
+        start += len(sents)
+    
+    return corpus_lemmas
+
 def tokenize_lemma(doc):
     """
     Applies TweetTokenization, then lemmatization.
@@ -324,26 +1108,35 @@ def tokenize_lemma(doc):
     
     Uses TweetTokenizer to tokenize documents first, and remove handles. Also
     gets POS tags. Then uses NLTK lemmatization on each token with POS tags.
-    """
-    tweettokenizer = TweetTokenizer(preserve_case=False, strip_handles=True)
-    lemmatizer = WordNetLemmatizer()
     
+    Use `tokenize_lemma_corpus` to process many documents at once.
+    """
+    return _tokenize_lemma_chunk([doc])[0]
 
-    # split doc into sentences first
-    sents = sent_tokenize(doc)
-
-    # tokenize using TweetTokenizer and add POS tags for lemmatization
-    pos_tagged = [nltk.pos_tag(tweettokenizer.tokenize(sent)) for sent in sents]
+def tokenize_lemma_corpus(docs, n_jobs=1, chunk_size=1000, verbose=False):
+    """Applies `tokenize_lemma` to a whole corpus of documents, returning a
+    list with the lemmas for each document in the same order as `docs`.
+    
+    Documents are split into chunks of `chunk_size`, and all sentences in a
+    chunk are POS tagged together. Lemmas are cached per process on 
+    (token, wordnet POS), up to `LEMMA_CACHE_SIZE` entries.
     
-    # lemmatize using NLTK
-    lemmas = []
-    for sent in pos_tagged:
-        new_sent = [lemmatizer.lemmatize(token[0], pos_converter(token[1])) 
-                    if pos_converter(token[1]) is not None else token[0] 
-                    for token in sent ]
-        lemmas.extend(new_sent)
+    n_jobs: int, default 1. Number of worker processes to spread the chunks
+    over, using joblib. Use -1 for all CPUs. With 1, the chunks are processed
+    in the current process.
     
-    # stem using NLTK
-    # final_tokens = [stemmer.stem(token, ) for token in lemmas]
+    verbose: Boolean, default False. Passed to joblib to report progress.
+    """
+    docs = list(docs)
+    chunks = [docs[i:i + chunk_size] for i in range(0, len(docs), chunk_size)]
+    
+    if n_jobs == 1:
+        chunk_lemmas = [_tokenize_lemma_chunk(chunk) for chunk in chunks]
+    else:
+        # workers get the current cache size, since they import the module
+        # with its default
+        chunk_lemmas = joblib.Parallel(n_jobs=n_jobs, verbose=verbose)(
+            joblib.delayed(_tokenize_lemma_chunk)(chunk, LEMMA_CACHE_SIZE) 
+            for chunk in chunks)
     
-    return lemmas
\ No newline at end of file
+    return [lemmas for chunk in chunk_lemmas for lemmas in chunk]
@@ -0,0 +1,235 @@
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline
+from sklearn import metrics
+from ml_tools import model_eval
+
+
+class HashingFeatures(BaseEstimator, TransformerMixin):
+    """Stateless replacement for the `cols_trans` ColumnTransformer of the
+    modeling notebook: hashes the text column into n-gram counts with a
+    `HashingVectorizer`, and hashes each categorical column as
+    `column=value` with a `FeatureHasher`, instead of learning a vocabulary
+    and one-hot categories.
+
+    Nothing needs to be fit, so chunks of any size can be transformed
+    independently, i.e. when the data doesn't fit in memory.
+
+    *** Arguments
+
+    cat_cols: list of categorical column names, i.e.
+    `['post_type', 'hour_cat', 'on_weekend']`.
+
+    text_col: string, default `cleaned`.
+
+    n_features: int, default 2**20. Number of hashed text features; collisions
+    are rare well below this many distinct n-grams.
+
+    tokenizer, stop_words, ngram_range, binary: passed to the
+    `HashingVectorizer`, as for the notebook's `CountVectorizer`.
+
+    n_cat_features: int, default 2**10. Number of hashed categorical
+    features.
+    """
+
+    def __init__(self, cat_cols, text_col='cleaned', n_features=2 ** 20,
+                 tokenizer=None, stop_words=None, ngram_range=(1, 2),
+                 binary=False, n_cat_features=2 ** 10):
+        self.cat_cols = cat_cols
+        self.text_col = text_col
+        self.n_features = n_features
+        self.tokenizer = tokenizer
+        self.stop_words = stop_words
+        self.ngram_range = ngram_range
+        self.binary = binary
+        self.n_cat_features = n_cat_features
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        vect = HashingVectorizer(n_features=self.n_features,
+                                 tokenizer=self.tokenizer,
+                                 stop_words=self.stop_words,
+                                 ngram_range=self.ngram_range,
+                                 binary=self.binary, alternate_sign=False,
+                                 norm='l2')
+        text = vect.transform(X[self.text_col].fillna('').astype(str))
+        if len(self.cat_cols) == 0:
+            return text
+
+        # one `col=value` string per categorical column per row
+        cats = X[self.cat_cols].astype(str)
+        rows = (cats.columns.values + '=' + cats.values).tolist()
+        hasher = FeatureHasher(n_features=self.n_cat_features,
+                               input_type='string', alternate_sign=False)
+        return sparse.hstack([hasher.transform(rows), text], format='csr')
+
+
+def iter_chunks(source, chunksize=50000, columns=None):
+    """Yields dataframes of up to `chunksize` rows from `source`, which can
+    be:
+    - a path to a CSV or Parquet file (or Parquet dataset directory, i.e.
+    from `storage.write_archive_parquet`), read a chunk at a time
+    - a function returning an iterable of dataframes, i.e.
+    `lambda: storage.iter_fb_posts(path)`, called each time
+    - a dataframe, split into chunks
+
+    Only `columns` are read from files, if given.
+    """
+    if isinstance(source, pd.DataFrame):
+        for start in range(0, len(source), chunksize):
+            chunk = source.iloc[start:start + chunksize]
+            yield chunk if columns is None else chunk[columns]
+    elif callable(source):
+        for chunk in source():
+            yield chunk if columns is None else chunk[columns]
+    elif str(source).endswith('.csv') or str(source).endswith('.csv.gz'):
+        for chunk in pd.read_csv(source, usecols=columns,
+                                 chunksize=chunksize):
+            yield chunk
+    else:
+        dataset = ds.dataset(source, format='parquet', partitioning='hive')
+        for batch in dataset.to_batches(columns=columns,
+                                        batch_size=chunksize):
+            if batch.num_rows > 0:
+                yield batch.to_pandas()
+
+
+def _balanced_weights(counts):
+    """Class weights like sklearn's `class_weight='balanced'`, from counts."""
+    total = sum(counts.values())
+    return {cls: total / (len(counts) * count)
+            for cls, count in counts.items()}
+
+
+def train_out_of_core(source, target_col, cat_cols, text_col='cleaned',
+                      clf=None, classes=None, class_weight='balanced',
+                      n_epochs=1, chunksize=50000, verbose=True,
+                      **hashing_params):
+    """Trains a classifier on data streamed from disk a chunk at a time, for
+    data too large to fit in memory. Text and categories are hashed with
+    `HashingFeatures`, and the classifier is updated with `partial_fit` on
+    each chunk.
+
+    Returns a fit Pipeline of `hash` and `clf` steps, which works like the
+    pipelines from the modeling notebook: it predicts on a dataframe with
+    `text_col` and `cat_cols`, so it can be evaluated with
+    `model_eval.eval_clf_model` on a test set that fits in memory, or with
+    `evaluate_out_of_core` on one that doesn't.
+
+    *** Arguments
+
+    source: data to train on; see `iter_chunks`. Must be readable more than
+    once if `classes` isn't given, `class_weight` is `balanced` or
+    `n_epochs` is more than 1.
+
+    target_col: string. Label column, i.e. `all_binary` (0 average, 1 high)
+    or `all_multi` (0 average, 1 moderate, 2 high), as in the notebook.
+
+    clf: classifier with `partial_fit` (optional). Default is an
+    `SGDClassifier` with log loss, so it has `predict_proba`.
+
+    classes: list (optional). All label values. Found with a pass over the
+    labels if None.
+
+    class_weight: 'balanced', dict or None, default 'balanced'. Applied
+    through sample weights, since `partial_fit` can't balance classes
+    itself. 'balanced' counts the labels in a pass over the data first.
+
+    n_epochs: int, default 1. Passes over the data.
+
+    hashing_params: passed to `HashingFeatures`, i.e. `tokenizer`,
+    `stop_words`, `ngram_range`, `n_features`.
+    """
+    if clf is None:
+        clf = SGDClassifier(loss='log_loss', alpha=1e-5, random_state=42)
+    else:
+        clf = clone(clf)
+    hasher = HashingFeatures(cat_cols, text_col=text_col, **hashing_params)
+    columns = [text_col] + list(cat_cols) + [target_col]
+
+    if classes is None or class_weight == 'balanced':
+        counts = {}
+        for chunk in iter_chunks(source, chunksize, columns=[target_col]):
+            for cls, count in chunk[target_col].value_counts().items():
+                counts[cls] = counts.get(cls, 0) + count
+        if classes is None:
+            classes = sorted(counts)
+        if class_weight == 'balanced':
+            class_weight = _balanced_weights(counts)
+        if verbose:
+            print(f"Label counts: {dict(sorted(counts.items()))}")
+    classes = np.asarray(classes)
+
+    for epoch in range(n_epochs):
+        n_rows = 0
+        for chunk in iter_chunks(source, chunksize, columns=columns):
+            chunk = chunk.loc[chunk[target_col].notna()]
+            if len(chunk) == 0:
+                continue
+            y = chunk[target_col].values
+
+            sample_weight = None
+            if class_weight is not None:
+                sample_weight = pd.Series(y).map(class_weight).values
+
+            clf.partial_fit(hasher.transform(chunk), y, classes=classes,
+                            sample_weight=sample_weight)
+            n_rows += len(chunk)
+        if verbose:
+            print(f"Epoch {epoch + 1}: trained on {n_rows} rows")
+
+    return Pipeline([('hash', hasher.fit(None)), ('clf', clf)])
+
+
+def evaluate_out_of_core(pipe, source, target_col, chunksize=50000):
+    """Evaluates a fit pipeline on test data streamed a chunk at a time,
+    accumulating one confusion matrix instead of keeping the test set in
+    memory.
+
+    Returns results in the format of `model_eval.evaluate_clf_model`, for
+    `model_eval.metrics_table` and `model_eval.plot_clf_results`. Only the
+    true values, predictions and scores are kept, not the features.
+    """
+    clf = pipe[-1]
+    classes = np.asarray(clf.classes_)
+    cm = np.zeros((len(classes), len(classes)), dtype=np.int64)
+    y_true, preds, scores = [], [], []
+
+    for chunk in iter_chunks(source, chunksize):
+        chunk = chunk.loc[chunk[target_col].notna()]
+        if len(chunk) == 0:
+            continue
+        y = chunk[target_col].values
+        features = pipe[:-1].transform(chunk)
+        chunk_preds = clf.predict(features)
+        cm += metrics.confusion_matrix(y, chunk_preds, labels=classes)
+
+        y_true.append(y)
+        preds.append(chunk_preds)
+        if hasattr(clf, 'predict_proba'):
+            chunk_scores = clf.predict_proba(features)
+            if len(classes) == 2:
+                chunk_scores = chunk_scores[:, 1]
+            scores.append(chunk_scores)
+
+    y_true = np.concatenate(y_true)
+    scores = np.concatenate(scores) if len(scores) > 0 else None
+
+    mets = model_eval.metrics_from_cm(cm)
+    if len(classes) == 2 and scores is not None:
+        y_pos = y_true == classes[1]
+        mets['roc_auc'] = metrics.roc_auc_score(y_pos, scores)
+        mets['average_precision'] = metrics.average_precision_score(y_pos,
+                                                                    scores)
+
+    return {'test': {'classes': classes, 'y_true': y_true,
+                     'preds': np.concatenate(preds), 'scores': scores,
+                     'cm': cm, 'metrics': mets}}
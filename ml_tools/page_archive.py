@@ -0,0 +1,265 @@
+import gzip
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin
+from ml_tools import fetch
+
+# file extensions read from a page directory without a manifest
+PAGE_EXTENSIONS = ('.html', '.htm', '.html.gz', '.htm.gz')
+
+
+def iter_directory_pages(archive_dir):
+    """Yields (link, final_url, path) for each page saved in `archive_dir`.
+
+    Directories written by `fetch.scrape_comment_counts(...,
+    archive_dir=...)` have a `fetch.PAGE_MANIFEST` with each page's link and
+    final URL. In any other directory, every HTML file (optionally gzipped)
+    is read, with its path relative to `archive_dir` as the link and no
+    final URL, so archive redirects can't be detected.
+    """
+    manifest_path = os.path.join(archive_dir, fetch.PAGE_MANIFEST)
+    if os.path.exists(manifest_path):
+        pages = {}
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    page = json.loads(line)
+                except ValueError:
+                    # partial last line from an interrupted run
+                    continue
+                # the latest save of a link wins
+                pages[page['link']] = page
+        for page in pages.values():
+            yield (page['link'], page['final_url'],
+                   os.path.join(archive_dir, page['file']))
+        return
+
+    for root, dirs, files in os.walk(archive_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(PAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, archive_dir), None, path
+
+
+def iter_warc_records(path):
+    """Yields (headers, block) for each record of a WARC file, optionally
+    gzipped (per record or as a whole). `headers` is a dictionary of the
+    WARC headers and `block` the record's content as bytes.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        while True:
+            line = f.readline()
+            if not line:
+                return
+            if not line.strip():
+                # blank lines between records
+                continue
+            if not line.startswith(b'WARC/'):
+                raise ValueError(f"Not a WARC record header: {line[:50]!r}")
+
+            headers = {}
+            for line in iter(f.readline, b''):
+                if not line.strip():
+                    break
+                name, _, value = line.decode('utf-8', 'replace').partition(':')
+                headers[name.strip()] = value.strip()
+            block = f.read(int(headers.get('Content-Length', 0)))
+            yield headers, block
+
+
+def _dechunk(body):
+    """Decodes an HTTP body sent with chunked transfer encoding."""
+    out = []
+    pos = 0
+    while pos < len(body):
+        end = body.find(b'\r\n', pos)
+        if end == -1:
+            break
+        size = int(body[pos:end].split(b';')[0].strip() or b'0', 16)
+        if size == 0:
+            break
+        out.append(body[end + 2:end + 2 + size])
+        pos = end + 2 + size + 2
+    return b''.join(out)
+
+
+def iter_warc_responses(path):
+    """Yields (url, status, http_headers, body) for each HTTP response
+    record in a WARC file, i.e. from `wget --warc-file`. Header names are
+    lowercase, and bodies are de-chunked and decompressed.
+    """
+    for headers, block in iter_warc_records(path):
+        if headers.get('WARC-Type') != 'response' or \
+                'application/http' not in headers.get('Content-Type', ''):
+            continue
+
+        head, _, body = block.partition(b'\r\n\r\n')
+        lines = head.decode('iso-8859-1').split('\r\n')
+        try:
+            status = int(lines[0].split()[1])
+        except (IndexError, ValueError):
+            continue
+        http_headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            http_headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in http_headers.get('transfer-encoding', '').lower():
+            body = _dechunk(body)
+        if http_headers.get('content-encoding', '').lower() in ['gzip',
+                                                                'x-gzip']:
+            try:
+                body = gzip.decompress(body)
+            except (OSError, EOFError):
+                pass
+        yield headers.get('WARC-Target-URI'), status, http_headers, body
+
+
+def _read_page(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        return f.read()
+
+
+def _parse_batch(pages, engine):
+    """Parses a batch of (link, final_url, html or path, is_path) tuples in
+    a worker process.
+    """
+    records = []
+    for link, final_url, page, is_path in pages:
+        html = _read_page(page) if is_path else page
+        records.append(fetch.parse_comment_page(html, final_url, link=link,
+                                                engine=engine))
+    return records
+
+
+def _iter_jobs(source, redirects):
+    """Yields (link, final_url, html or path, is_path) for each page in
+    `source`, a page directory or WARC file. Only successful HTML responses
+    are read from a WARC file, and redirects found in it are added to
+    `redirects`.
+    """
+    if os.path.isdir(source):
+        for link, final_url, path in iter_directory_pages(source):
+            yield link, final_url, path, True
+        return
+
+    for url, status, http_headers, body in iter_warc_responses(source):
+        if 300 <= status < 400 and 'location' in http_headers:
+            redirects[url] = urljoin(url, http_headers['location'])
+        elif 200 <= status < 300 and \
+                'text/html' in http_headers.get('content-type', '').lower():
+            # skip images, scripts and other resources saved with the pages
+            yield url, url, body, False
+
+
+def _resolve_redirects(records, redirects):
+    """Relabels WARC page records with the links that were requested,
+    following redirect chains from each requested link to the page it
+    ended on. Links whose final page isn't in the WARC get a record from
+    their final URL alone, like a page without a count.
+
+    Every page record is kept under its own URL too, since a URL can be
+    both requested directly and the target of a redirect.
+    """
+    targets = set(redirects.values())
+    by_url = {record['link']: record for record in records}
+    resolved = list(by_url.values())
+
+    for link in redirects:
+        if link in targets or link in by_url:
+            # middle of a chain, or already has its own record
+            continue
+        final_url = link
+        for _ in range(20):
+            if final_url not in redirects:
+                break
+            final_url = redirects[final_url]
+        if final_url in by_url:
+            record = dict(by_url[final_url], link=link)
+            if record['comments'] == -1:
+                record['archived'] = int('archive.nytimes' in final_url)
+        else:
+            record = fetch.parse_comment_page('', final_url, link=link)
+        resolved.append(record)
+    return resolved
+
+
+def parse_saved_pages(source, n_jobs=None, batch_size=200, engine='regex',
+                      log_path=None, verbose=True):
+    """Parses comment counts from saved pages instead of a live browser,
+    with `fetch.parse_comment_page` in a pool of worker processes.
+
+    Returns a list of `{'link', 'comments', 'archived'}` records, like
+    `fetch.scrape_comment_counts`.
+
+    *** Arguments
+
+    source: string. A page directory (see `iter_directory_pages`) or a WARC
+    file (`.warc` or `.warc.gz`). Pages in a directory are read by the
+    workers; WARC records are read here and sent to the workers in batches.
+    In a WARC, each page gets a record under its own URL, and one under
+    each link that redirected to it, following any redirects recorded in
+    the file.
+
+    n_jobs: int (optional). Number of worker processes; all CPUs if None.
+    With 1, pages are parsed in this process.
+
+    batch_size: int, default 200. Pages sent to a worker at a time.
+
+    engine: string, default 'regex'. See `fetch.parse_comment_page`.
+
+    log_path: string (optional). Appends the records to this log in the
+    format of `fetch.scrape_comment_counts`, so `fetch.load_comment_log`
+    reads them and a later scrape skips these links.
+    """
+    redirects = {}
+    jobs = _iter_jobs(source, redirects)
+    records = []
+
+    def batches():
+        batch = []
+        for job in jobs:
+            batch.append(job)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    if n_jobs == 1:
+        for batch in batches():
+            records.extend(_parse_batch(batch, engine))
+    else:
+        n_workers = n_jobs or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # only a few batches in flight at a time, so a large WARC file
+            # is never all in memory
+            max_pending = 2 * n_workers
+            pending = set()
+            for batch in batches():
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        records.extend(future.result())
+                pending.add(executor.submit(_parse_batch, batch, engine))
+            for future in pending:
+                records.extend(future.result())
+
+    if len(redirects) > 0:
+        records = _resolve_redirects(records, redirects)
+
+    if verbose:
+        n_found = sum(1 for record in records if record['comments'] != -1)
+        n_archived = sum(record['archived'] for record in records)
+        print(f"Parsed {len(records)} pages: {n_found} with comment counts, "
+              f"{n_archived} archived")
+
+    if log_path is not None:
+        with open(log_path, 'a', encoding='utf-8') as log:
+            for record in records:
+                log.write(json.dumps(record) + '\n')
+    return records
@@ -0,0 +1,379 @@
+import argparse
+import json
+import queue
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import joblib
+import numpy as np
+import pandas as pd
+from ml_tools import nlp_prep
+
+# stages timed by `ScoringService`
+STAGES = ['clean', 'transform', 'predict']
+
+
+def export_scoring_pipeline(gsfile_name, out_path, load_path=''):
+    """Saves the best pipeline from a GridSearch object dumped by
+    `model_eval.clf_gridsearch_wpipe` in a form `ScoringService` can
+    memory-map: uncompressed, so its arrays are loaded from disk on demand
+    and shared between processes serving the same file.
+
+    The best pipeline was already refit on all the training data by the
+    GridSearch, so nothing is refit here.
+    """
+    gs = joblib.load(load_path + gsfile_name)
+    pipe = gs.best_estimator_
+    if 'memory' in pipe.get_params():
+        pipe.set_params(memory=None)
+    joblib.dump(pipe, out_path)
+    print(f"Saved scoring pipeline to: {out_path}")
+
+
+class ScoringService():
+    """Scores new posts with a fit pipeline, i.e. to check the predicted
+    engagement of drafts before publishing.
+
+    The pipeline is loaded once, memory-mapped if it was saved uncompressed
+    (see `export_scoring_pipeline`). Each post's raw text is cleaned with
+    `nlp_prep.clean_docs_batch` into the `cleaned` column the pipeline was
+    trained on; tokenization happens inside the pipeline's vectorizer, as in
+    training.
+
+    The time spent cleaning, transforming and predicting is recorded per
+    batch; see `latency`.
+
+    *** Arguments
+
+    model_path: string. Path of a joblib dump of a fit pipeline, or of a
+    GridSearch object (the best pipeline is used).
+
+    labels: list (optional). Names for the classes, in class order, i.e.
+    `['Low', 'High']`. Class values are used if None.
+
+    raw_text_col: string, default `message`. Field of each post holding the
+    text to clean. Posts that already have `text_col` aren't cleaned again.
+
+    text_col: string, default `cleaned`. Text column the pipeline expects.
+
+    *** Example
+
+    service = ScoringService('models/LR_all_binary.joblib', ['Low', 'High'])
+    service.score([{'message': 'Draft text', 'post_type': 'link',
+                    'hour_cat': 'morning', 'on_weekend': 0}])
+    """
+
+    def __init__(self, model_path, labels=None, raw_text_col='message',
+                 text_col='cleaned'):
+        with warnings.catch_warnings():
+            # compressed dumps can't be memory-mapped, and are just loaded
+            warnings.filterwarnings('ignore', message='mmap_mode')
+            model = joblib.load(model_path, mmap_mode='r')
+        self.pipe = getattr(model, 'best_estimator_', model)
+
+        classes = self.pipe[-1].classes_
+        self.labels = list(labels) if labels is not None else list(classes)
+        self.raw_text_col = raw_text_col
+        self.text_col = text_col
+        self.columns = list(getattr(self.pipe, 'feature_names_in_',
+                                    [text_col]))
+
+        self._lock = threading.Lock()
+        self.reset_latency()
+
+    def reset_latency(self):
+        """Clears the recorded latencies."""
+        with self._lock:
+            self._stage_secs = {stage: 0.0 for stage in STAGES}
+            self._batches = 0
+            self._posts = 0
+
+    def latency(self):
+        """Returns a dataframe of the total seconds spent in each stage, and
+        the mean milliseconds per batch and per post, since the service
+        started or `reset_latency` was called.
+        """
+        with self._lock:
+            secs = dict(self._stage_secs)
+            batches, posts = self._batches, self._posts
+
+        df = pd.DataFrame({'total_secs': pd.Series(secs)})
+        df.loc['total'] = df['total_secs'].sum()
+        df['ms_per_batch'] = df['total_secs'] * 1000 / max(batches, 1)
+        df['ms_per_post'] = df['total_secs'] * 1000 / max(posts, 1)
+        df.index.name = 'stage'
+        return df
+
+    def _prepare(self, posts):
+        """Turns posts (a dataframe, or a list of dictionaries) into the
+        dataframe the pipeline expects, cleaning raw text where needed.
+        """
+        df = pd.DataFrame(posts)
+        if len(df) == 0:
+            return df
+
+        if self.text_col not in df:
+            df[self.text_col] = np.nan
+        to_clean = df[self.text_col].isna()
+        if to_clean.any():
+            if self.raw_text_col not in df:
+                raise ValueError(f"Posts need a `{self.raw_text_col}` or "
+                                 f"`{self.text_col}` field.")
+            raw = df.loc[to_clean, self.raw_text_col].fillna('')
+            df.loc[to_clean, self.text_col] = \
+                nlp_prep.clean_docs_batch(raw.astype(str)).values
+
+        missing = [col for col in self.columns if col not in df]
+        if len(missing) > 0:
+            raise ValueError(f"Posts are missing fields: {missing}")
+        return df[self.columns]
+
+    def score(self, posts):
+        """Scores a batch of posts.
+
+        posts: dataframe, or list of dictionaries, with the fields the
+        pipeline was trained on (i.e. `post_type`, `hour_cat`, `on_weekend`)
+        and either raw text in `raw_text_col` or cleaned text in `text_col`.
+
+        Returns a dataframe with the predicted label in `engagement` and one
+        `proba_<label>` column per class (if the classifier has
+        `predict_proba`), in the same order as `posts`.
+        """
+        times = {}
+
+        start = time.perf_counter()
+        X = self._prepare(posts)
+        times['clean'] = time.perf_counter() - start
+        if len(X) == 0:
+            return pd.DataFrame(columns=['engagement'])
+
+        start = time.perf_counter()
+        features = self.pipe[:-1].transform(X)
+        times['transform'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        clf = self.pipe[-1]
+        classes = list(clf.classes_)
+        if hasattr(clf, 'predict_proba'):
+            probas = clf.predict_proba(features)
+            preds = np.asarray(classes)[probas.argmax(axis=1)]
+        else:
+            probas = None
+            preds = clf.predict(features)
+        times['predict'] = time.perf_counter() - start
+
+        results = pd.DataFrame(
+            {'engagement': [self.labels[classes.index(p)] for p in preds]},
+            index=X.index)
+        if probas is not None:
+            for i, label in enumerate(self.labels):
+                results[f"proba_{label}"] = probas[:, i]
+
+        with self._lock:
+            for stage, secs in times.items():
+                self._stage_secs[stage] += secs
+            self._batches += 1
+            self._posts += len(X)
+        return results
+
+
+class MicroBatcher():
+    """Collects posts from concurrent callers into batches for a
+    `ScoringService`, since scoring one large batch is much faster than
+    scoring many single posts.
+
+    A batch is scored as soon as it has `max_batch` posts, or `max_wait_ms`
+    after its first post arrived, whichever comes first. If scoring a batch
+    fails, each request in it is scored on its own, so only the requests
+    that caused the error get it.
+    """
+
+    def __init__(self, service, max_batch=256, max_wait_ms=10):
+        self.service = service
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def score(self, posts):
+        """Scores a list of post dictionaries along with any other posts
+        submitted at the same time. Blocks until they're scored and returns
+        a list of result dictionaries. Raises the scoring error, if any.
+        """
+        request = {'posts': list(posts), 'done': threading.Event()}
+        self._queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['results']
+
+    def _run(self):
+        while True:
+            requests_ = [self._queue.get()]
+            n_posts = len(requests_[0]['posts'])
+            deadline = time.monotonic() + self.max_wait
+
+            while n_posts < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                requests_.append(request)
+                n_posts += len(request['posts'])
+
+            posts = [post for request in requests_
+                     for post in request['posts']]
+            try:
+                results = self.service.score(posts).to_dict('records')
+            except Exception as e:
+                if len(requests_) == 1:
+                    requests_[0]['error'] = e
+                    requests_[0]['done'].set()
+                else:
+                    # one bad request mustn't fail the others batched with
+                    # it, so score each on its own to find which failed
+                    for request in requests_:
+                        self._score_alone(request)
+                continue
+
+            start = 0
+            for request in requests_:
+                end = start + len(request['posts'])
+                request['results'] = results[start:end]
+                request['done'].set()
+                start = end
+
+    def _score_alone(self, request):
+        try:
+            request['results'] = \
+                self.service.score(request['posts']).to_dict('records')
+        except Exception as e:
+            request['error'] = e
+        request['done'].set()
+
+
+class _ScoringServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections under concurrent load
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def _make_handler(batcher):
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/latency':
+                latency = batcher.service.latency()
+                self._send(200, latency.reset_index().to_dict('records'))
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length))
+                posts = body['posts'] if isinstance(body, dict) and \
+                    'posts' in body else body
+                if isinstance(posts, dict):
+                    posts = [posts]
+                results = batcher.score(posts)
+            except (ValueError, KeyError, TypeError) as e:
+                self._send(400, {'error': str(e)})
+            except Exception as e:
+                # i.e. from the model, so the client isn't left hanging
+                self._send(500, {'error': f"{type(e).__name__}: {e}"})
+            else:
+                self._send(200, {'results': results})
+
+        def log_message(self, format, *args):
+            # don't print a line per request
+            pass
+
+    return ScoringHandler
+
+
+def serve(service, host='127.0.0.1', port=8000, max_batch=256,
+          max_wait_ms=10):
+    """Serves a `ScoringService` over HTTP until interrupted.
+
+    - `POST /score` with a JSON list of posts, a single post, or
+    `{"posts": [...]}` returns `{"results": [...]}`, one per post
+    - `GET /latency` returns the per stage latencies
+
+    Concurrent requests are scored together by a `MicroBatcher`.
+    """
+    batcher = MicroBatcher(service, max_batch=max_batch,
+                           max_wait_ms=max_wait_ms)
+    server = _ScoringServer((host, port), _make_handler(batcher))
+    print(f"Scoring posts at http://{host}:{server.server_port}/score")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return server
+
+
+def main(argv=None):
+    """Command line entry point:
+
+    python -m ml_tools.scoring score MODEL posts.jsonl --out scores.csv
+    python -m ml_tools.scoring serve MODEL --port 8000
+    """
+    parser = argparse.ArgumentParser(
+        description="Score the predicted engagement of posts.")
+    parser.add_argument('command', choices=['score', 'serve'])
+    parser.add_argument('model', help="joblib dump of the fit pipeline")
+    parser.add_argument('posts', nargs='?',
+                        help="posts to score, as a JSON lines or CSV file")
+    parser.add_argument('--out', help="CSV file for scores; printed if "
+                                      "not given")
+    parser.add_argument('--labels', nargs='+', help="class names, in order")
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    args = parser.parse_args(argv)
+
+    service = ScoringService(args.model, labels=args.labels)
+
+    if args.command == 'serve':
+        serve(service, host=args.host, port=args.port,
+              max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+        return
+
+    if args.posts is None:
+        parser.error("score needs a posts file")
+    if args.posts.endswith('.csv'):
+        reader = pd.read_csv(args.posts, chunksize=args.batch_size)
+    else:
+        reader = pd.read_json(args.posts, lines=True,
+                              chunksize=args.batch_size)
+
+    scores = pd.concat([service.score(chunk) for chunk in reader])
+    if args.out:
+        scores.to_csv(args.out)
+    else:
+        print(scores.to_string())
+    print(service.latency().round(3).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+import gzip
+import json
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Low cardinality article fields, stored as categoricals (dictionary encoded
+# in Parquet)
+ARTICLE_CATEGORICALS = ['print_section', 'source', 'document_type',
+                        'news_desk', 'section_name', 'type_of_material']
+
+# Keyword types in the NYT API `keywords` field; each becomes a list column
+# named `kw_<type>`
+ARTICLE_KEYWORD_TYPES = ['subject', 'persons', 'glocations', 'organizations',
+                         'creative_works']
+
+
+def flatten_articles(articles):
+    """Flattens a list of NYT API article dictionaries into a typed dataframe.
+
+    - `headline` becomes `main_headline` and `print_headline` strings
+    - `keywords` becomes one list of values per keyword type, i.e.
+    `kw_subject` and `kw_persons`
+    - `byline` becomes the `byline_original` string, i.e. "By Dan McGrath"
+    - `multimedia` becomes the `multimedia_count` int
+    - `pub_date` becomes a UTC datetime, with `year` and `month` ints
+    - `word_count` becomes int32, and the `ARTICLE_CATEGORICALS` columns
+    become categoricals
+
+    Other top-level fields are kept as they are.
+    """
+    rows = []
+    for article in articles:
+        row = {key: value for key, value in article.items()
+               if key not in ['headline', 'keywords', 'byline', 'multimedia']}
+
+        headline = article.get('headline') or {}
+        row['main_headline'] = headline.get('main')
+        row['print_headline'] = headline.get('print_headline')
+
+        for kw_type in ARTICLE_KEYWORD_TYPES:
+            row[f"kw_{kw_type}"] = []
+        for keyword in article.get('keywords') or []:
+            col = f"kw_{keyword.get('name')}"
+            if col in row:
+                row[col].append(keyword.get('value'))
+
+        byline = article.get('byline') or {}
+        row['byline_original'] = byline.get('original')
+        row['multimedia_count'] = len(article.get('multimedia') or [])
+        rows.append(row)
+
+    df = pd.DataFrame(rows)
+    if len(df) == 0:
+        return df
+
+    df['pub_date'] = pd.to_datetime(df['pub_date'], utc=True, errors='coerce')
+    df['year'] = df['pub_date'].dt.year.astype('Int16')
+    df['month'] = df['pub_date'].dt.month.astype('Int8')
+    if 'word_count' in df:
+        df['word_count'] = pd.to_numeric(df['word_count'],
+                                         errors='coerce').astype('Int32')
+    df['multimedia_count'] = df['multimedia_count'].astype(np.int16)
+
+    for col in ARTICLE_CATEGORICALS:
+        if col in df:
+            df[col] = df[col].astype('category')
+
+    return df
+
+
+def write_archive_parquet(articles, out_dir):
+    """Flattens a list of article dictionaries with `flatten_articles` and
+    writes them to a Parquet dataset in `out_dir`, partitioned by `year` and
+    `month` (i.e. `out_dir/year=2012/month=1/`). Partitions being written
+    replace any existing data for that month, so rerunning a conversion
+    doesn't duplicate articles.
+    """
+    df = flatten_articles(articles)
+    if len(df) == 0:
+        return
+
+    # nested types can't be stored in a dataframe-wide schema, so any other
+    # nested fields the API adds are stored as JSON strings
+    for col in df.columns:
+        if not col.startswith('kw_') and df[col].dtype == object and \
+                df[col].map(lambda v: isinstance(v, (dict, list))).any():
+            df[col] = df[col].map(lambda v: json.dumps(v)
+                                  if isinstance(v, (dict, list)) else v)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_to_dataset(table, root_path=out_dir,
+                        partition_cols=['year', 'month'],
+                        existing_data_behavior='delete_matching')
+
+
+def archive_checkpoints_to_parquet(years, months, checkpoint_dir, out_dir):
+    """Converts the per-month archive checkpoints written by
+    `fetch.fetch_archive` into a Parquet dataset, one month at a time so
+    only one month of articles is ever in memory.
+
+    To convert the original `nyt_articles_2012_to_2016.pickle.gz` instead,
+    unpickle it once and pass the list to `write_archive_parquet`.
+    """
+    for year in years:
+        for month in months:
+            path = os.path.join(checkpoint_dir,
+                                f"archive_{year}_{int(month):02d}.json.gz")
+            if not os.path.exists(path):
+                print(f"No checkpoint for {month}, {year}")
+                continue
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                write_archive_parquet(json.load(f), out_dir)
+
+
+def load_archive_parquet(path, columns=None, years=None, months=None,
+                         filters=None):
+    """Loads articles from the Parquet dataset written by
+    `write_archive_parquet`.
+
+    Only the requested `columns` are read, and partitions outside `years`
+    and `months` are skipped without being opened. Files are memory-mapped.
+
+    *** Arguments
+
+    path: string. Root directory of the dataset.
+
+    columns: list (optional). Columns to load, i.e.
+    `['_id', 'web_url', 'snippet', 'main_headline', 'pub_date']` for
+    matching. All columns if None.
+
+    years, months: lists of ints (optional). Partitions to load.
+
+    filters: list (optional). Extra pyarrow filters pushed down to the
+    reader, i.e. `[('section_name', '=', 'U.S.')]`.
+    """
+    all_filters = list(filters) if filters is not None else []
+    if years is not None:
+        all_filters.append(('year', 'in', list(years)))
+    if months is not None:
+        all_filters.append(('month', 'in', list(months)))
+
+    # read partition keys with the types they were written with
+    partitioning = ds.partitioning(pa.schema([('year', pa.int16()),
+                                              ('month', pa.int8())]),
+                                   flavor='hive')
+    table = pq.read_table(path, columns=columns,
+                          filters=all_filters if all_filters else None,
+                          partitioning=partitioning, memory_map=True)
+    return table.to_pandas()
+
+
+# Columns of the Facebook posts export, i.e.
+# `the-new-york-times-5281959998.csv`
+FB_COUNT_COLS = ['likes_count', 'comments_count', 'shares_count',
+                 'love_count', 'wow_count', 'haha_count', 'sad_count',
+                 'thankful_count', 'angry_count']
+FB_CATEGORICALS = ['post_type', 'status_type']
+FB_POST_DTYPES = {'id': str, 'page_id': 'int64', 'name': str, 'message': str,
+                  'description': str, 'caption': str, 'link': str,
+                  'picture': str,
+                  **{col: 'category' for col in FB_CATEGORICALS},
+                  **{col: 'int32' for col in FB_COUNT_COLS}}
+
+
+def transcode_to_utf8(src_path, dst_path, encoding='utf_16',
+                      chunk_chars=2 ** 20):
+    """Rewrites a text file in UTF-8, streaming it in chunks so the file
+    never has to fit in memory. A leading byte order mark is dropped, and
+    line endings are left as they are so newlines inside quoted fields
+    survive.
+
+    The Facebook posts export is UTF-16 LE with a BOM; `utf_16` reads the
+    BOM to pick the byte order.
+    """
+    tmp_path = dst_path + '.tmp'
+    with open(src_path, 'r', encoding=encoding, newline='') as src, \
+            open(tmp_path, 'w', encoding='utf-8', newline='') as dst:
+        first = True
+        while True:
+            chunk = src.read(chunk_chars)
+            if not chunk:
+                break
+            if first:
+                chunk = chunk.lstrip('\ufeff')
+                first = False
+            dst.write(chunk)
+    os.replace(tmp_path, dst_path)
+
+
+def _is_fresh(path, src_path):
+    """Whether `path` exists and was written after `src_path` was changed."""
+    return os.path.exists(path) and \
+        os.path.getmtime(path) >= os.path.getmtime(src_path)
+
+
+def _fb_utf8_copy(csv_path, utf8_path, encoding):
+    """Returns the path of a UTF-8 copy of `csv_path`, transcoding it only if
+    there isn't an up to date copy already.
+    """
+    if utf8_path is None:
+        utf8_path = os.path.splitext(csv_path)[0] + '.utf8.csv'
+    if not _is_fresh(utf8_path, csv_path):
+        transcode_to_utf8(csv_path, utf8_path, encoding=encoding)
+    return utf8_path
+
+
+def _finish_fb_posts(df):
+    df['posted_at'] = pd.to_datetime(df['posted_at'], errors='coerce')
+    return df
+
+
+def iter_fb_posts(csv_path, chunksize=100000, encoding='utf_16',
+                  utf8_path=None):
+    """Reads the Facebook posts CSV in chunks of `chunksize` rows, for files
+    too large to load at once. Yields typed dataframes like `load_fb_posts`.
+
+    The file is transcoded to UTF-8 once (at `utf8_path`, by default next to
+    the CSV as `<name>.utf8.csv`) so the C parser can be used. Categories
+    of `post_type` and `status_type` are only those present in each chunk.
+    """
+    utf8_path = _fb_utf8_copy(csv_path, utf8_path, encoding)
+    reader = pd.read_csv(utf8_path, encoding='utf-8', engine='c',
+                         dtype=FB_POST_DTYPES, chunksize=chunksize)
+    for chunk in reader:
+        yield _finish_fb_posts(chunk)
+
+
+def load_fb_posts(csv_path, engine='c', encoding='utf_16', utf8_path=None,
+                  cache_path=None, refresh=False):
+    """Loads the Facebook posts CSV (i.e.
+    `data/the-new-york-times-5281959998.csv`) with explicit dtypes, instead
+    of `pd.read_csv(..., encoding='utf_16_le', engine='python')`.
+
+    - `post_type` and `status_type` are categoricals
+    - reaction and engagement counts are int32
+    - `posted_at` is a datetime; use `df['posted_at'].dt.strftime('%Y-%m-%d')`
+    where the date string is needed
+    - other columns are strings, as before
+
+    The first load transcodes the file to UTF-8 once and parses that with a
+    fast engine, then saves a typed Parquet copy at `cache_path` (by default
+    next to the CSV as `<name>.parquet`). Later loads read the Parquet copy,
+    unless the CSV has changed since or `refresh` is True.
+
+    *** Arguments
+
+    engine: string, default 'c'. Parser for the transcoded CSV, 'c' or
+    'pyarrow'.
+
+    encoding: string, default 'utf_16'. Encoding of the original CSV.
+
+    utf8_path: string (optional). Where to keep the UTF-8 copy.
+
+    cache_path: string (optional). Where to keep the Parquet copy, or False
+    to not cache.
+    """
+    if cache_path is None:
+        cache_path = os.path.splitext(csv_path)[0] + '.parquet'
+    if cache_path and not refresh and _is_fresh(cache_path, csv_path):
+        return pd.read_parquet(cache_path)
+
+    utf8_path = _fb_utf8_copy(csv_path, utf8_path, encoding)
+    if engine == 'pyarrow':
+        # called directly, since pandas doesn't pass through the option for
+        # newlines inside quoted fields
+        column_types = {}
+        for col, dtype in FB_POST_DTYPES.items():
+            if dtype == 'category':
+                column_types[col] = pa.dictionary(pa.int32(), pa.string())
+            elif dtype is str:
+                column_types[col] = pa.string()
+            else:
+                column_types[col] = pa.type_for_alias(dtype)
+        table = pa_csv.read_csv(
+            utf8_path,
+            parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+            convert_options=pa_csv.ConvertOptions(column_types=column_types,
+                                                  strings_can_be_null=True))
+        df = table.to_pandas()
+    elif engine == 'c':
+        df = pd.read_csv(utf8_path, encoding='utf-8', engine='c',
+                         dtype=FB_POST_DTYPES)
+    else:
+        print("Error: engine must be 'c' or 'pyarrow'.")
+        return None
+    df = _finish_fb_posts(df)
+
+    if cache_path:
+        df.to_parquet(cache_path, index=False)
+    return df
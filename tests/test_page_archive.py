@@ -0,0 +1,33 @@
+import gzip
+from ml_tools import page_archive
+
+PAGE = (b'<html><body><span id="comments-speech-bubble-top">'
+        b'<span>12</span></span></body></html>')
+
+
+def warc_response(url, body, content_type, status='200 OK'):
+    """Returns a WARC response record for an HTTP response with `body`."""
+    http = (f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n").encode('ascii') + body
+    headers = (f"WARC/1.0\r\nWARC-Type: response\r\n"
+               f"WARC-Target-URI: {url}\r\n"
+               f"Content-Type: application/http; msgtype=response\r\n"
+               f"Content-Length: {len(http)}\r\n\r\n").encode('ascii')
+    return headers + http + b'\r\n\r\n'
+
+
+def test_warc_only_parses_html_responses(tmp_path):
+    path = str(tmp_path / 'pages.warc.gz')
+    with gzip.open(path, 'wb') as f:
+        f.write(warc_response('https://www.nytimes.com/story.html', PAGE,
+                              'text/html; charset=utf-8'))
+        f.write(warc_response('https://www.nytimes.com/logo.png',
+                              b'\x89PNG\r\n\x1a\n', 'image/png'))
+        f.write(warc_response('https://www.nytimes.com/missing.html',
+                              b'<html></html>', 'text/html',
+                              status='404 Not Found'))
+
+    records = page_archive.parse_saved_pages(path, n_jobs=1, verbose=False)
+
+    assert records == [{'link': 'https://www.nytimes.com/story.html',
+                        'comments': 12, 'archived': 0}]
@@ -0,0 +1,55 @@
+import threading
+import pandas as pd
+import pytest
+from ml_tools import scoring
+
+
+class StubService():
+    """Scores posts with a `message`, and fails batches with any post
+    missing one, like `ScoringService` does for missing fields.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def score(self, posts):
+        self.calls += 1
+        df = pd.DataFrame(posts)
+        if 'message' not in df or df['message'].isna().any():
+            raise ValueError("Posts need a `message` field.")
+        return pd.DataFrame({'engagement': df['message'].str.len()})
+
+
+def test_bad_request_only_fails_itself():
+    service = StubService()
+    # long wait so both requests land in the same batch
+    batcher = scoring.MicroBatcher(service, max_batch=2, max_wait_ms=5000)
+
+    results = {}
+
+    def submit(name, posts):
+        try:
+            results[name] = batcher.score(posts)
+        except ValueError as e:
+            results[name] = e
+
+    threads = [threading.Thread(target=submit, args=args)
+               for args in [('good', [{'message': 'hi'}]),
+                            ('bad', [{'x': 1}])]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert results['good'] == [{'engagement': 2}]
+    assert isinstance(results['bad'], ValueError)
+    # one failed batch, then one call per request
+    assert service.calls == 3
+
+
+def test_single_bad_request_is_not_rescored():
+    service = StubService()
+    batcher = scoring.MicroBatcher(service, max_batch=1)
+    with pytest.raises(ValueError):
+        batcher.score([{'x': 1}])
+    assert service.calls == 1